@@ -2,6 +2,10 @@
 
 from __future__ import print_function, division
 import multiprocessing
+from multiprocessing.pool import ThreadPool
+from multiprocessing import shared_memory
+import queue
+import threading
 import os
 import sys
 import gc
@@ -27,14 +31,15 @@ from matplotlib.patches import Polygon
 from matplotlib.collections import PatchCollection
 from scipy.stats import multivariate_normal
 from scipy.stats import norm
+from scipy.spatial import cKDTree
 
 import io
+import json
 from keras.models import Sequential
 from keras.layers import Activation, Dense, Dropout
 from keras.objectives import MSE, MAE
 from keras.callbacks import EarlyStopping
 from keras.models import model_from_json
-from keras.models import load_model
 
 
 from datetime import datetime
@@ -46,15 +51,23 @@ mplt = mcmcplt.Mcmcplot()
 
 class Network:
 
-    def __init__(self, Topo, Train, Test, learn_rate):
+    def __init__(self, Topo, Train, Test, learn_rate, random_init=True):  # random_init=False leaves the weights at zero and the global RNG untouched
         self.Top = Topo  # NN topology [input, hidden, output]
         self.TrainData = Train
         self.TestData = Test
         self.lrate = learn_rate
-        self.W1 = np.random.randn(self.Top[0], self.Top[1]) / np.sqrt(self.Top[0])
-        self.B1 = np.random.randn(1, self.Top[1]) / np.sqrt(self.Top[1])  # bias first layer
-        self.W2 = np.random.randn(self.Top[1], self.Top[2]) / np.sqrt(self.Top[1])
-        self.B2 = np.random.randn(1, self.Top[2]) / np.sqrt(self.Top[1])  # bias second layer
+        w_layer1size = self.Top[0] * self.Top[1]
+        w_layer2size = self.Top[1] * self.Top[2]
+        self.w_flat = np.zeros(w_layer1size + w_layer2size + self.Top[1] + self.Top[2])  # single contiguous buffer, W1 W2 B1 B2 are persistent views into it
+        self.W1 = self.w_flat[0:w_layer1size].reshape(self.Top[0], self.Top[1])
+        self.W2 = self.w_flat[w_layer1size:w_layer1size + w_layer2size].reshape(self.Top[1], self.Top[2])
+        self.B1 = self.w_flat[w_layer1size + w_layer2size:w_layer1size + w_layer2size + self.Top[1]].reshape(1, self.Top[1])
+        self.B2 = self.w_flat[w_layer1size + w_layer2size + self.Top[1]:].reshape(1, self.Top[2])
+        if random_init is True:
+            self.W1[:] = np.random.randn(self.Top[0], self.Top[1]) / np.sqrt(self.Top[0])
+            self.B1[:] = np.random.randn(1, self.Top[1]) / np.sqrt(self.Top[1])  # bias first layer
+            self.W2[:] = np.random.randn(self.Top[1], self.Top[2]) / np.sqrt(self.Top[1])
+            self.B2[:] = np.random.randn(1, self.Top[2]) / np.sqrt(self.Top[1])  # bias second layer
         self.hidout = np.zeros((1, self.Top[1]))  # output of first hidden layer
         self.out = np.zeros((1, self.Top[2]))  # output last layer
         self.pred_class = 0
@@ -78,6 +91,16 @@ class Network:
 
         ## print(self.pred_class, self.out, '  ---------------- out ')
 
+    def BatchForwardPass(self, X): # whole data matrix at once
+        # stacked (N,1,in) products keep the per-row accumulation order so results match ForwardPass bit for bit
+        z1 = np.matmul(X[:, np.newaxis, :], self.W1) - self.B1
+        hidout = self.sigmoid(z1)
+        z2 = np.matmul(hidout, self.W2) - self.B2
+        self.hidout = hidout[:, 0, :]
+        self.out = self.sigmoid(z2)[:, 0, :]
+
+        self.pred_class = np.argmax(self.out, axis=1)
+
     '''def BackwardPass(self, Input, desired):
         out_delta = (desired - self.out).dot(self.out.dot(1 - self.out))
         hid_delta = out_delta.dot(self.W2.T) * (self.hidout * (1 - self.hidout))
@@ -104,32 +127,20 @@ class Network:
 
 
     def decode(self, w):
-        w_layer1size = self.Top[0] * self.Top[1]
-        w_layer2size = self.Top[1] * self.Top[2]
-
-        w_layer1 = w[0:w_layer1size]
-        self.W1 = np.reshape(w_layer1, (self.Top[0], self.Top[1]))
-
-        w_layer2 = w[w_layer1size:w_layer1size + w_layer2size]
-        self.W2 = np.reshape(w_layer2, (self.Top[1], self.Top[2]))
-        self.B1 = w[w_layer1size + w_layer2size:w_layer1size + w_layer2size + self.Top[1]].reshape(1,self.Top[1])
-        self.B2 = w[w_layer1size + w_layer2size + self.Top[1]:w_layer1size + w_layer2size + self.Top[1] + self.Top[2]].reshape(1,self.Top[2])
-
+        np.copyto(self.w_flat, w)  # loading a proposal is one copy, the layer views see it directly
 
 
     def encode(self):
-        w1 = self.W1.ravel()
-        w1 = w1.reshape(1,w1.shape[0])
-        w2 = self.W2.ravel()
-        w2 = w2.reshape(1,w2.shape[0])
-        w = np.concatenate([w1.T, w2.T, self.B1.T, self.B2.T])
-        w = w.reshape(-1)
-        return w
+        return self.w_flat  # no copy, callers that keep the result past the next decode must copy it
 
     def softmax(self):
-        prob = np.exp(self.out)/np.sum(np.exp(self.out))
+        prob = np.exp(self.out)/np.sum(np.exp(self.out), axis=-1, keepdims=True)
         return prob
 
+    def log_softmax(self): # shifted by the row max so exp never overflows
+        shifted = self.out - np.max(self.out, axis=-1, keepdims=True)
+        return shifted - np.log(np.sum(np.exp(shifted), axis=-1, keepdims=True))
+
 
 
     def langevin_gradient(self, data, w, depth):  # BP with SGD (Stocastic BP)
@@ -148,15 +159,21 @@ class Network:
                 Desired = data[pat, self.Top[0]:]
                 self.ForwardPass(Input)
                 self.BackwardPass(Input, Desired)
-        w_updated = self.encode()
+        w_updated = self.encode().copy()
 
         return  w_updated
 
-    def evaluate_proposal(self, data, w ):  # BP with SGD (Stocastic BP)
+    def evaluate_proposal(self, data, w, batch=True):  # batch=False keeps the original row by row loop
 
         self.decode(w)  # method to decode w into W1, W2, B1, B2.
         size = data.shape[0]
 
+        if batch is True:
+            self.BatchForwardPass(data[:, 0:self.Top[0]])
+            fx = self.pred_class.astype(float)
+            prob = self.softmax()
+            return fx, prob
+
         Input = np.zeros((1, self.Top[0]))  # temp hold input
         Desired = np.zeros((1, self.Top[2]))
         fx = np.zeros(size)
@@ -173,6 +190,170 @@ class Network:
 
         return fx, prob
 
+    def evaluate_proposals(self, data, w_stack):  # K proposals (K, num_param) in one pass over the data
+
+        w_layer1size = self.Top[0] * self.Top[1]
+        w_layer2size = self.Top[1] * self.Top[2]
+        num = w_stack.shape[0]
+
+        W1 = w_stack[:, 0:w_layer1size].reshape(num, self.Top[0], self.Top[1])
+        W2 = w_stack[:, w_layer1size:w_layer1size + w_layer2size].reshape(num, self.Top[1], self.Top[2])
+        B1 = w_stack[:, w_layer1size + w_layer2size:w_layer1size + w_layer2size + self.Top[1]].reshape(num, 1, self.Top[1])
+        B2 = w_stack[:, w_layer1size + w_layer2size + self.Top[1]:w_layer1size + w_layer2size + self.Top[1] + self.Top[2]].reshape(num, 1, self.Top[2])
+
+        # (N,in) x (K,in,hid) -> (K,N,hid), one matrix product per proposal over the shared data
+        # results agree with evaluate_proposal to rounding (not bit for bit, the products are blocked differently)
+        self.hidout = self.sigmoid(np.matmul(data[:, 0:self.Top[0]], W1) - B1)
+        self.out = self.sigmoid(np.matmul(self.hidout, W2) - B2)
+        self.pred_class = np.argmax(self.out, axis=2)
+
+        fx = self.pred_class.astype(float)  # (K, N)
+        prob = self.softmax()  # (K, N, out)
+        return fx, prob
+
+
+def stacked_likelihood(fnn, data, w_stack, topology):  # untempered log-likelihood, fx and rmse of each proposal in a (K, num_param) stack, one pass over the data
+    y = data[:, topology[0]]
+    fx, prob = fnn.evaluate_proposals(data, w_stack)
+    lhood = np.sum(fnn.log_softmax()[:, np.arange(data.shape[0]), y.astype(int)], axis=1) # log(prob[k, i, y_i]) gathered directly, no one-hot
+    return lhood, fx, np.sqrt(((fx - y)**2).mean(axis=1))
+
+def sq_distances(X, Z):
+    d = np.sum(X**2, axis=1)[:,None] + np.sum(Z**2, axis=1)[None,:] - 2*X.dot(Z.T)
+    return np.maximum(d, 0)
+
+def median_lengthscale(X):  # median heuristic on at most 500 rows
+    idx = np.random.choice(X.shape[0], min(500, X.shape[0]), replace=False)
+    d = np.sqrt(sq_distances(X[idx], X[idx]))
+    d = d[np.triu_indices(d.shape[0], 1)]
+    return np.median(d) if d.size > 0 and np.median(d) > 0 else 1.0
+
+
+class SparseGP: # subset-of-regressors GP with an RBF kernel on a random set of inducing points
+
+    def __init__(self, model_topology):
+        self.num_inducing = [100, 200, 400][model_topology-1]
+        self.Z = None
+
+    def kernel(self, X, Z):
+        return self.variance*np.exp(-0.5*sq_distances(X, Z)/self.lengthscale**2)
+
+    def train(self, X, Y):
+        self.Z = None
+        self.partial_fit(X, Y)
+
+    def partial_fit(self, X, Y):  # the inducing points and kernel are fixed by the first batch, later batches only add to the m x m sufficient statistics
+        y = Y.ravel()
+        if self.Z is None:
+            self.Z = X[np.random.choice(X.shape[0], min(self.num_inducing, X.shape[0]), replace=False)]
+            self.lengthscale = median_lengthscale(X)
+            self.variance = max(np.var(y), 1e-8)
+            self.noise = 0.01*self.variance
+            self.Kmm = self.kernel(self.Z, self.Z)
+            self.KK = np.zeros_like(self.Kmm)
+            self.Ky = np.zeros(self.Z.shape[0])
+            self.K1 = np.zeros(self.Z.shape[0])
+            self.n = 0
+            self.sum_y = 0.0
+        Kmn = self.kernel(self.Z, X)
+        self.KK += Kmn.dot(Kmn.T)
+        self.Ky += Kmn.dot(y)
+        self.K1 += Kmn.sum(axis=1)
+        self.n += y.shape[0]
+        self.sum_y += y.sum()
+        self.mean = self.sum_y/self.n
+        A = self.noise*self.Kmm + self.KK + 1e-8*self.variance*np.eye(self.Z.shape[0])
+        self.alpha = np.linalg.solve(A, self.Ky - self.mean*self.K1)
+
+    def predict(self, X):
+        return self.kernel(X, self.Z).dot(self.alpha) + self.mean
+
+    def get_state(self):
+        return [self.Z, self.alpha, np.array([self.lengthscale, self.variance, self.mean])]
+
+    def set_state(self, state):
+        self.Z, self.alpha, (self.lengthscale, self.variance, self.mean) = state
+
+
+class RandomFeatureRidge: # random Fourier features of an RBF kernel followed by ridge regression
+
+    def __init__(self, model_topology):
+        self.num_features = [256, 512, 1024][model_topology-1]
+        self.ridge = 1e-3
+        self.omega = None
+
+    def features(self, X):
+        return np.sqrt(2.0/self.num_features)*np.cos(X.dot(self.omega) + self.phase)
+
+    def train(self, X, Y):
+        self.omega = None
+        self.partial_fit(X, Y)
+
+    def partial_fit(self, X, Y):  # recursive least squares: the features are drawn once, later batches only add to the D x D normal equations
+        y = Y.ravel()
+        if self.omega is None:
+            self.omega = np.random.randn(X.shape[1], self.num_features)/median_lengthscale(X)
+            self.phase = np.random.uniform(0, 2*np.pi, self.num_features)
+            self.FF = np.zeros((self.num_features, self.num_features))
+            self.Fy = np.zeros(self.num_features)
+            self.F1 = np.zeros(self.num_features)
+            self.n = 0
+            self.sum_y = 0.0
+        F = self.features(X)
+        self.FF += F.T.dot(F)
+        self.Fy += F.T.dot(y)
+        self.F1 += F.sum(axis=0)
+        self.n += y.shape[0]
+        self.sum_y += y.sum()
+        F_mean = self.F1/self.n
+        A = self.FF - self.n*np.outer(F_mean, F_mean)  # centred features, the intercept is not penalised
+        A[np.diag_indices_from(A)] += self.ridge*np.trace(A)/self.num_features + 1e-10
+        self.coef = np.linalg.solve(A, self.Fy - F_mean*self.sum_y)
+        self.mean = self.sum_y/self.n - F_mean.dot(self.coef)
+
+    def predict(self, X):
+        return self.features(X).dot(self.coef) + self.mean
+
+    def get_state(self):
+        return [self.omega, self.phase, self.coef, np.array([self.mean])]
+
+    def set_state(self, state):
+        self.omega, self.phase, self.coef, (self.mean,) = state
+
+
+class NearestNeighbours: # inverse distance weighted k nearest neighbours on a kd-tree
+
+    def __init__(self, model_topology):
+        self.k = [5, 10, 20][model_topology-1]
+        self.max_points = 20000 # oldest points are dropped beyond this so the tree build stays bounded
+
+    def train(self, X, Y):
+        self.X = X.copy()
+        self.Y = Y.ravel().copy()
+        self.tree = cKDTree(self.X)
+
+    def partial_fit(self, X, Y):
+        self.X = np.concatenate([self.X, X])[-self.max_points:]
+        self.Y = np.concatenate([self.Y, Y.ravel()])[-self.max_points:]
+        self.tree = cKDTree(self.X)
+
+    def predict(self, X):
+        dist, idx = self.tree.query(X, k=min(self.k, self.X.shape[0]))
+        dist = dist.reshape(X.shape[0], -1)
+        idx = idx.reshape(X.shape[0], -1)
+        weight = 1.0/(dist + 1e-12)
+        return np.sum(weight*self.Y[idx], axis=1)/np.sum(weight, axis=1)
+
+    def get_state(self):
+        return [self.X, self.Y]
+
+    def set_state(self, state):
+        self.X, self.Y = state
+        self.tree = cKDTree(self.X)
+
+
+surrogate_backends = {"gp": SparseGP, "rff": RandomFeatureRidge, "knn": NearestNeighbours} # lightweight alternatives to "krnn", same train/predict on the normalised likelihood
+
 
 class surrogate: #General Class for surrogate models for predicting likelihood given the weights
 
@@ -191,9 +372,12 @@ class surrogate: #General Class for surrogate models for predicting likelihood g
         self.max_X = max_X
 
         self.model_topology = model_topology
+        self.weights = None # numpy copy of the Dense layer weights [W1, b1, W2, b2, W3, b3] used for inference
+        self.partial_epochs = 5
 
         self.save_surrogate_data =  save_surrogate_data
 
+        self.model = model
         if model=="gp":
             self.model_id = 1
         elif model == "nn":
@@ -201,8 +385,14 @@ class surrogate: #General Class for surrogate models for predicting likelihood g
         elif model == "krnn": # keras nn
             self.model_id = 3
             self.krnn = Sequential()
+        elif model == "rff":
+            self.model_id = 4
+        elif model == "knn":
+            self.model_id = 5
         else:
             print("Invalid Model!")
+        if model in surrogate_backends:
+            self.backend = surrogate_backends[model](model_topology)
 
     def normalize(self, X):
         maxer = np.zeros((1,X.shape[1]))
@@ -244,22 +434,9 @@ class surrogate: #General Class for surrogate models for predicting likelihood g
 
 
         if self.model_id is 3:
-            if self.model_signature==1.0:
+            if self.model_signature==1.0 or len(self.krnn.layers) == 0:
                 self.krnn = self.create_model()
-            else:
-                while True:
-                    try:
-                        # You can see two options to initialize model now. If you uncomment the first line then the model id loaded at every time with stored weights. On the other hand if you uncomment the second line a new model will be created every time without the knowledge from previous training. This is basically the third scheme we talked about for surrogate experiments.
-                        # To implement the second scheme you need to combine the data from each training.
-
-                        self.krnn = load_model(self.path+'/model_krnn_%s_.h5'%(model_signature-1))
-                        #self.krnn = self.create_model()
-                        break
-                    except EnvironmentError as e:
-                        # pass
-                        # # print(e.errno)
-                        # time.sleep(1)
-                        print ('ERROR in loading latest surrogate model, loading previous one in TRAIN')
+            # otherwise keep training the model held in memory from the previous interval (replace by create_model() to train from scratch every time)
 
             early_stopping = EarlyStopping(monitor='val_loss', patience=5)
             self.krnn.compile(loss='mse', optimizer='adam', metrics=['mse'])
@@ -268,10 +445,6 @@ class surrogate: #General Class for surrogate models for predicting likelihood g
             scores = self.krnn.evaluate(X_test, y_test.ravel(), verbose = 0)
             # print("%s: %.5f" % (self.krnn.metrics_names[1], scores[1]))
 
-            self.krnn.save(self.path+'/model_krnn_%s_.h5' %self.model_signature)
-            # print("Saved model to disk  ", self.model_signature)
-
-
             '''plt.plot(train_log.history["loss"], label="loss")
             plt.plot(train_log.history["val_loss"], label="val_loss")
             plt.savefig(self.path+'/%s_0.png'%(self.model_signature))
@@ -280,61 +453,344 @@ class surrogate: #General Class for surrogate models for predicting likelihood g
             results = np.array([scores[1]])
             # print(results, 'train-metrics')
 
+        else:
+            self.backend.train(X_train, y_train)
+            results = np.array([np.mean((self.backend.predict(X_test) - y_test.ravel())**2)])
 
-            with open(('%s/train_metrics.txt' % (self.path)),'ab') as outfile:
-                np.savetxt(outfile, results)
+        with open(('%s/train_metrics.txt' % (self.path)),'ab') as outfile:
+            np.savetxt(outfile, results)
 
-            if self.save_surrogate_data is True:
-                with open(('%s/learnsurrogate_data/X_train.csv' % (self.path)),'ab') as outfile:
-                    np.savetxt(outfile, X_train)
-                with open(('%s/learnsurrogate_data/Y_train.csv' % (self.path)),'ab') as outfile:
-                    np.savetxt(outfile, y_train)
-                with open(('%s/learnsurrogate_data/X_test.csv' % (self.path)),'ab') as outfile:
-                    np.savetxt(outfile, X_test)
-                with open(('%s/learnsurrogate_data/Y_test.csv' % (self.path)),'ab') as outfile:
-                    np.savetxt(outfile, y_test)
+    def partial_fit(self, X, Y, model_signature):  # update with the new batch only, keras continues with its optimizer state and fewer epochs
+        self.X = X
+        self.Y = Y
+        self.model_signature = model_signature
 
-    def predict(self, X_load, initialized):
+        if self.model_id == 3:
+            early_stopping = EarlyStopping(monitor='val_loss', patience=2)
+            self.krnn.fit(X, Y.ravel(), batch_size=50, epochs=self.partial_epochs, validation_split=0.1, verbose=0, callbacks=[early_stopping])
+            results = np.array([self.krnn.evaluate(X, Y.ravel(), verbose = 0)[1]])
+        else:
+            self.backend.partial_fit(X, Y)
+            results = np.array([np.mean((self.backend.predict(X) - Y.ravel())**2)])
 
+        with open(('%s/train_metrics.txt' % (self.path)),'ab') as outfile:
+            np.savetxt(outfile, results)
 
-        if self.model_id == 3:
+    def predict(self, X_load):
 
-            if initialized == False:
-                model_sign = np.loadtxt(self.path+'/model_signature.txt')
-                self.model_signature = model_sign
-                while True:
-                    try:
-                        self.krnn = load_model(self.path+'/model_krnn_%s_.h5'%self.model_signature)
-                        # # print (' Tried to load file : ', self.path+'/model_krnn_%s_.h5'%self.model_signature)
-                        break
-                    except EnvironmentError as e:
-                        print(e)
-                        # pass
 
-                self.krnn.compile(loss='mse', optimizer='rmsprop', metrics=['mse'])
-                krnn_prediction =-1.0
-                prediction = -1.0
+        if self.model_id == 3:
 
+            if self.weights is not None:
+                krnn_prediction = self.forward(X_load)[0]
+                prediction = krnn_prediction*(self.max_Y[0,0]-self.min_Y[0,0]) + self.min_Y[0,0]
             else:
                 krnn_prediction = self.krnn.predict(X_load)[0]
                 prediction = krnn_prediction*(self.max_Y[0,0]-self.min_Y[0,0]) + self.min_Y[0,0]
 
-            return prediction, krnn_prediction
+        else:
+            krnn_prediction = self.backend.predict(X_load)
+            prediction = krnn_prediction*(self.max_Y[0,0]-self.min_Y[0,0]) + self.min_Y[0,0]
+
+        return prediction, krnn_prediction
+
+    def get_weights(self):
+        if self.model_id == 3:
+            return self.krnn.get_weights()
+        return self.backend.get_state()
+
+    def set_weights(self, weights):  # hot-swap the weights broadcast by the trainer, inference runs in numpy so no keras model is built
+        if self.model_id == 3:
+            self.weights = [np.asarray(a, dtype=np.float64) for a in weights]
+        else:
+            self.backend.set_state(weights)
+
+    def forward(self, X):  # relu -> relu -> sigmoid, same as the model from create_model() without the keras call overhead
+        W1, b1, W2, b2, W3, b3 = self.weights
+        h1 = np.maximum(X.dot(W1) + b1, 0)
+        h2 = np.maximum(h1.dot(W2) + b2, 0)
+        return 1.0/(1.0 + np.exp(-(h2.dot(W3) + b3)))
+
+
+class ReplicaState: # replica states, ladder slots and surrogate training rows in one shared memory block, so swaps and handoffs never pickle arrays
+
+    def __init__(self, num_param, num_chains, capacity):
+        self.num_param = num_param
+        self.capacity = capacity
+        layout = [('state', (num_chains, num_param+3), np.float64), # w, untempered log-likelihood, log prior, temperature the owner ran at
+                  ('temperature', (num_chains,), np.float64), # temperature of each ladder position, moved by the ladder adaptation
+                  ('slot', (num_chains,), np.int64), # ladder position -> row of state holding its configuration
+                  ('rows', (num_chains, capacity, num_param+1), np.float64), # each replica's ring of (w, likelihood) training rows
+                  ('consumed', (num_chains,), np.int64), # rows the trainer has read from each ring
+                  ('pair_attempts', (num_chains-1,), np.int64), # swap attempts of each adjacent pair, counted by its lower replica
+                  ('pair_accepts', (num_chains-1,), np.int64)]
+        self.layout = layout
+        self.memory = shared_memory.SharedMemory(create=True, size=sum(8*int(np.prod(shape)) for name, shape, dtype in layout))
+        self.attach()
+        self.slot[:] = np.arange(num_chains)
+        self.consumed[:] = 0
+        self.pair_attempts[:] = 0
+        self.pair_accepts[:] = 0
+
+    def attach(self):  # numpy views into the block, rebuilt after unpickling
+        offset = 0
+        for name, shape, dtype in self.layout:
+            setattr(self, name, np.ndarray(shape, dtype=dtype, buffer=self.memory.buf, offset=offset))
+            offset += 8*int(np.prod(shape))
+
+    def __getstate__(self):  # a spawned process gets the block's name (SharedMemory pickles by name) and attaches, the views are not copied
+        state = self.__dict__.copy()
+        for name, shape, dtype in self.layout:
+            del state[name]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.attach()
+
+    def batch(self, index, first, count):  # copy of rows [first, first + count) of a replica's ring
+        return self.rows[index][np.arange(first, first + count) % self.capacity]
+
+    def release(self):  # the views have to go before the block can be closed
+        for name, shape, dtype in self.layout:
+            delattr(self, name)
+        self.memory.close()
+        self.memory.unlink()
+
+
+class SharedArray: # read-only array in a shared memory block, every replica attaches to the same pages instead of holding its own copy
+
+    def __init__(self, array):
+        self.shape = array.shape
+        self.dtype = array.dtype
+        self.memory = shared_memory.SharedMemory(create=True, size=max(1, array.nbytes))
+        np.ndarray(self.shape, dtype=self.dtype, buffer=self.memory.buf)[:] = array
+        self.attach()
+
+    def attach(self):
+        self.array = np.ndarray(self.shape, dtype=self.dtype, buffer=self.memory.buf)
+        self.array.flags.writeable = False
+
+    def __getstate__(self):  # pickled as the block's name, so a spawned process attaches rather than unpickling a copy
+        state = self.__dict__.copy()
+        del state['array']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.attach()
+
+    def release(self):
+        del self.array
+        self.memory.close()
+        self.memory.unlink()
+
+
+def memory_usage():  # (peak, private, shared memory) resident set of this process in MB, from /proc on Linux, zeros elsewhere
+    usage = {}
+    if os.path.exists('/proc/self/status'):
+        with open('/proc/self/status') as status:
+            for line in status:
+                key, value = line.split(':', 1)
+                if key in ('VmHWM', 'RssAnon', 'RssShmem'):
+                    usage[key] = int(value.split()[0])/1024.0
+    return usage.get('VmHWM', 0.0), usage.get('RssAnon', 0.0), usage.get('RssShmem', 0.0)
+
+
+class SampleBuffer: # ring of (w, likelihood) rows a replica collects for the surrogate between intervals, lives in the shared ReplicaState
+
+    def __init__(self, data, consumed):
+        self.data = data
+        self.consumed = consumed # one element view, rows the trainer has read so far
+        self.capacity = data.shape[0]
+        self.position = 0 # rows written so far
+        self.start = 0 # first row not handed off yet
+        self.peak = 0
+        self.handoffs = 0
+        self.handed = 0
+        self.dropped = 0
+
+    def append(self, w, likelihood):
+        if self.position - self.consumed[0] >= self.capacity: # the trainer is a full ring behind, rows it has not read are never overwritten
+            self.dropped += 1
+            return
+        row = self.position % self.capacity
+        self.data[row, :-1] = w
+        self.data[row, -1] = likelihood
+        self.position += 1
+
+    def take(self):  # (first, count) of the rows since the last call, the trainer reads them straight from the ring
+        first = self.start
+        count = self.position - self.start
+        self.start = self.position
+        self.peak = max(self.peak, count)
+        self.handoffs += 1
+        self.handed += count
+        return first, count
+
+    def utilisation(self):
+        return self.peak/(self.capacity*1.0)
+
+
+posterior_datasets = ('pos_w', 'rmse_train', 'rmse_test', 'acc_train', 'acc_test') # show_results only reads these after burn-in, so store_burn_in and store_thinning apply to them
+
+
+class StreamArray: # a chain's (samples, ...) dataset as a .npy on disk, indexed by sample like an array while only a window of two blocks stays in memory
+
+    def __init__(self, file_name, samples, row_shape, dtype, block, fill, first=0, step=1):
+        self.samples = samples
+        self.first = first # first sample stored, every step-th one after it
+        self.step = step
+        self.shape = (len(range(first, samples, step)),) + row_shape
+        self.dtype = np.dtype(dtype)
+        self.row_shape = row_shape
+        self.row_bytes = self.dtype.itemsize * int(np.prod(row_shape))
+        self.block = block
+        self.fill = fill
+        self.window = np.full((2*block,) + row_shape, fill, dtype=self.dtype) # stored rows [start, start + 2 block)
+        self.start = 0 # stored rows before it are on disk
+        self.latest = -1 # newest sample set, kept whether it is stored or not since the chain reads it back
+        self.latest_row = np.full((1,) + row_shape, fill, dtype=self.dtype)
+        self.lock = threading.Lock() # the audit pool writes rows from its own thread
+        self.file = None # opted out of storage, only the window is kept for the chain's own look back
+        if file_name is not None:
+            self.file = open(file_name, 'wb+')
+            np.lib.format.write_array_header_1_0(self.file, {'descr': np.lib.format.dtype_to_descr(self.dtype), 'fortran_order': False, 'shape': self.shape})
+            self.offset = self.file.tell()
+            self.file.truncate(self.offset + self.shape[0]*self.row_bytes) # a complete .npy from the start, readable with np.load at any time
+
+    def write_rows(self, first, rows):
+        if self.file is None:
+            return
+        rows = rows[:max(0, self.shape[0] - first)]
+        self.file.seek(self.offset + first*self.row_bytes)
+        self.file.write(np.ascontiguousarray(rows).tobytes())
+        self.file.flush()
+
+    def read_row(self, row):
+        if self.file is None:
+            return np.full(self.row_shape, self.fill, dtype=self.dtype)
+        self.file.seek(self.offset + row*self.row_bytes)
+        return np.frombuffer(self.file.read(self.row_bytes), dtype=self.dtype).reshape(self.row_shape).copy()
+
+    def split(self, index):  # sample and the index within its row, negative samples count from the end like numpy
+        index = index if isinstance(index, tuple) else (index,)
+        sample = index[0] + self.samples if index[0] < 0 else index[0]
+        return sample, index[1:]
+
+    def stored_row(self, sample):  # row of a sample in the file, None if the storage policy drops it
+        if sample < self.first or (sample - self.first) % self.step != 0:
+            return None
+        return (sample - self.first)//self.step
+
+    def __setitem__(self, index, value):
+        sample, rest = self.split(index)
+        with self.lock:
+            if sample > self.latest:
+                self.latest = sample
+                self.latest_row[:] = self.fill
+            if sample == self.latest:
+                self.latest_row[(0,) + rest] = value
+            row = self.stored_row(sample)
+            if row is None:
+                return
+            while row >= self.start + 2*self.block: # slide forward a block at a time, the block that leaves is written out
+                self.write_rows(self.start, self.window[:self.block])
+                self.window[:self.block] = self.window[self.block:]
+                self.window[self.block:] = self.fill
+                self.start += self.block
+            if row >= self.start:
+                self.window[(row - self.start,) + rest] = value
+            else: # a late write, e.g. an audit that finished after its row left the window
+                data = self.read_row(row)
+                data[rest] = value
+                self.write_rows(row, data.reshape((1,) + self.row_shape))
+
+    def __getitem__(self, index):
+        sample, rest = self.split(index)
+        with self.lock:
+            if sample == self.latest:
+                return self.latest_row[(0,) + rest].copy()
+            row = self.stored_row(sample)
+            if row is not None and self.start <= row < self.start + 2*self.block:
+                return self.window[(row - self.start,) + rest].copy()
+            if row is None or row >= self.start: # dropped by the policy, or not reached yet
+                return np.full(self.row_shape, self.fill, dtype=self.dtype)[rest]
+            return self.read_row(row)[rest]
+
+    def flushed(self):  # samples up to which the stored rows are on disk
+        return min(self.samples, self.first + self.start*self.step)
+
+    def close(self):
+        with self.lock:
+            self.write_rows(self.start, self.window)
+            self.start = self.shape[0]
+            if self.file is not None:
+                self.file.close()
+
+
+class RunStore: # binary posterior store, one .npy per chain and dataset plus JSON metadata, read back memory-mapped without parsing
+
+    def __init__(self, path):
+        self.path = path + '/store'
+
+    def chain_path(self, temperature):
+        return self.path + '/chain_' + str(temperature)
+
+    def stream(self, temperature, name, samples, row_shape=(), dtype=np.float64, block=1000, fill=0.0, first=0, step=1, skip=False):  # a StreamArray written as the chain runs, skip keeps it off disk
+        os.makedirs(self.chain_path(temperature), exist_ok=True)
+        return StreamArray(None if skip else self.chain_path(temperature) + '/' + name + '.npy', samples, row_shape, dtype, block, fill, first, step)
+
+    def write_chain(self, temperature, datasets, complete=True, stored=None, **metadata):  # arrays are saved and streams closed, complete=False only records the progress. stored: name -> (first, step) of thinned arrays
+        path = self.chain_path(temperature)
+        os.makedirs(path, exist_ok=True)
+        stored = dict(stored or {})
+        for name in list(datasets):
+            if isinstance(datasets[name], StreamArray):
+                if complete:
+                    datasets[name].close()
+                if datasets[name].file is None: # opted out
+                    del datasets[name]
+                    continue
+                stored[name] = (datasets[name].first, datasets[name].step)
+            elif complete:
+                np.save(path + '/' + name + '.npy', datasets[name])
+        metadata['complete'] = complete
+        metadata['samples_flushed'] = min([datasets[name].flushed() for name in datasets if isinstance(datasets[name], StreamArray)] or [metadata.get('samples', 0)])
+        metadata['temperature'] = temperature
+        metadata['datasets'] = dict((name, {'shape': list(datasets[name].shape), 'dtype': str(datasets[name].dtype), 'first': int(stored.get(name, (0, 1))[0]), 'step': int(stored.get(name, (0, 1))[1])}) for name in datasets)
+        with open(path + '/metadata.json', 'w') as f:
+            json.dump(metadata, f, indent=1)
+
+    def write_run(self, **metadata):
+        os.makedirs(self.path, exist_ok=True)
+        with open(self.path + '/metadata.json', 'w') as f:
+            json.dump(metadata, f, indent=1)
+
+    def read(self, temperature, name):  # memory-mapped, slicing it only reads the pages it touches
+        return np.load(self.chain_path(temperature) + '/' + name + '.npy', mmap_mode='r')
+
+    def read_after(self, temperature, name, sample, row_shape=()):  # rows recorded at or after a sample index, whatever burn-in and thinning the chain stored with. empty if it was opted out
+        info = self.metadata(temperature)['datasets'].get(name)
+        if info is None:
+            return np.zeros((0,) + row_shape)
+        return self.read(temperature, name)[max(0, int(math.ceil((sample - info['first'])/(info['step']*1.0)))):]
+
+    def metadata(self, temperature=None):  # the run's metadata, or one chain's
+        path = self.path if temperature is None else self.chain_path(temperature)
+        with open(path + '/metadata.json') as f:
+            return json.load(f)
 
 
 class ptReplica(multiprocessing.Process):
 
-    def __init__(self, use_surrogate, use_langevin_gradients, learn_rate, save_surrogate_data, w, minlim_param, maxlim_param, samples, traindata, testdata, topology, burn_in, temperature, swap_interval, path, parameter_queue, pause_chain_event, resume_chain_event, surrogate_parameter_queue, surrogate_interval, surrogate_prob, surrogate_start, surrogate_resume, surrogate_topology):
+    def __init__(self, use_surrogate, use_langevin_gradients, learn_rate, save_surrogate_data, w, minlim_param, maxlim_param, samples, traindata, testdata, topology, burn_in, temperature, swap_interval, path, surrogate_parameter_queue, surrogate_model_queue, surrogate_interval, surrogate_prob, surrogate_topology, subsample_size, delayed_acceptance, surrogate_audit, replica_index, swap_barriers, replica_state, swap_scheme, adapt_temperatures, store_burn_in, store_thinning, store_skip):
         #MULTIPROCESSING VARIABLES
         multiprocessing.Process.__init__(self)
         self.processID = temperature
-        self.parameter_queue = parameter_queue
-        self.pause_chain_event = pause_chain_event
-        self.resume_chain_event = resume_chain_event
         #SURROGATE VARIABLES
         self.surrogate_parameter_queue = surrogate_parameter_queue
-        self.surrogate_start = surrogate_start
-        self.surrogate_resume = surrogate_resume
+        self.surrogate_model_queue = surrogate_model_queue
         self.surrogate_interval = surrogate_interval
         self.surrogate_prob = surrogate_prob
         #PARALLEL TEMPERING VARIABLES
@@ -348,11 +804,25 @@ class ptReplica(multiprocessing.Process):
         self.swap_interval = swap_interval
         self.path = path
         self.burn_in = burn_in
+        self.replica_index = replica_index # position in the temperature ladder
+        self.swap_barriers = swap_barriers # one Barrier(2) per adjacent pair, pair k is replicas k and k+1
+        self.replica_state = replica_state # shared states of all replicas, a swap exchanges two entries of its slot table
+        self.swap_scheme = swap_scheme # "alternate": even and odd pairs take turns, "all": every pair each round, even ones first
+        self.swap_timeout = 300 # seconds to wait for the partner before giving up on the pair
+        self.swap_attempts = 0
+        self.swap_accepts = 0
+        self.swap_idle = 0.0 # seconds spent waiting for partners
+        self.adapt_temperatures = adapt_temperatures # replica 0 moves the ladder during burn-in until adjacent swap rates are equal
+        self.ladder_temperature = temperature # current rung, self.temperature stays the chain's name in the output files
+        self.ladder_lag = 100 # swap rounds over which the adaptation gain halves
+        self.ladder_time = 10 # swap rounds, inverse of the initial gain
+        self.ladder_smoothing = 0.1 # weight of the latest round in the swap rate average
         #FNN CHAIN VARIABLES (MCMC)
         self.samples = samples
         self.topology = topology
-        self.traindata = traindata
-        self.testdata = testdata
+        self.shared_traindata = traindata # SharedArray, attached read-only
+        self.shared_testdata = testdata
+        self.launch_time = time.time() # reset when the process is started, for the start-up time report
         self.w = w
 
         self.num_param = w.shape[0]
@@ -367,16 +837,34 @@ class ptReplica(multiprocessing.Process):
 
         self.save_surrogate_data =  save_surrogate_data
 
-        self.compare_surrogate  = True
+        self.surrogate_audit = surrogate_audit # fraction of surrogate steps that are also evaluated with the true likelihood for the accuracy report
+        self.audit_workers = 1 # background threads for the audit, numpy releases the GIL in the forward pass
         self.sgd_depth = 1 # always should be 1
         self.learn_rate =   learn_rate # learn rate for langevin
 
         self.l_prob = 0.5  # can be evaluated for diff problems - if data too large keep this low value since the gradients cost comp time
 
+        self.subsample_size = subsample_size # rows per stochastic likelihood estimate, 0 evaluates the full training set every step
+        self.store_block = 1000 # samples per block streamed to the run store, memory holds two blocks per saved list
+        self.store_burn_in = store_burn_in # posterior_datasets start at the end of burn-in
+        self.store_thinning = store_thinning # and keep every so many samples
+        self.store_skip = store_skip # saved lists that are not written at all
+        self.subsample_refresh = 100 # full pass over the training set every so many samples to move the control variate to the current state
+
+        self.delayed_acceptance = delayed_acceptance # surrogate screens every proposal once trained, only survivors are evaluated on the training set
+
         langevin_count = 0
 
 
 
+    @property
+    def traindata(self):
+        return self.shared_traindata.array
+
+    @property
+    def testdata(self):
+        return self.shared_testdata.array
+
     def rmse(self, pred, actual):
 
         return np.sqrt(((pred-actual)**2).mean())
@@ -388,19 +876,102 @@ class ptReplica(multiprocessing.Process):
                 count+=1
         return 100*(count/pred.shape[0])
 
-    def likelihood_func(self, fnn, data, w):
+    def pointwise_likelihood(self, fnn, data, w): # log-likelihood of every row (not tempered)
         y = data[:, self.topology[0]]
-        fx, prob = fnn.evaluate_proposal(data,w)
-        rmse = self.rmse(fx,y)
-        z = np.zeros((data.shape[0],self.topology[2]))
-        lhood = 0
-        for i in range(data.shape[0]):
-            for j in range(self.topology[2]):
-                if j == y[i]:
-                    z[i,j] = 1
-                lhood += z[i,j]*np.log(prob[i,j])
+        fx, prob = fnn.evaluate_proposal(data, w)
+        log_prob = fnn.log_softmax()
+        return log_prob[np.arange(data.shape[0]), y.astype(int)], fx
+
+    def subsample_likelihood_func(self, fnn, data, w, ref_lhoods, batch_size):
+        # difference estimator: exact likelihood at the reference state plus the scaled minibatch mean of (l_i(w) - l_i(w_ref))
+        size = data.shape[0]
+        batch = np.random.choice(size, batch_size, replace=False)
+        lhoods, fx = self.pointwise_likelihood(fnn, data[batch], w)
+        diff = lhoods - ref_lhoods[batch]
+        lhood = np.sum(ref_lhoods) + size * np.mean(diff)
+        variance = size**2 * (1 - batch_size/(size*1.0)) * np.var(diff, ddof=1) / batch_size # sampling without replacement
+        rmse = self.rmse(fx, data[batch, self.topology[0]])
+        return [lhood/self.adapttemp, fx, rmse, lhood, variance, batch]
+
+    def likelihood_func(self, fnn, data, w):  # likelihood_func_batch for a stack of one
+        [likelihood, fx, rmse, lhood] = self.likelihood_func_batch(fnn, data, w[np.newaxis, :])
+        return [likelihood[0], fx[0], rmse[0], lhood[0]]
+
+    def likelihood_func_batch(self, fnn, data, w_stack):  # same as likelihood_func for a (K, num_param) stack of proposals, returns arrays of length K
+        lhood, fx, rmse = stacked_likelihood(fnn, data, w_stack, self.topology)
         return [lhood/self.adapttemp, fx, rmse, lhood]
 
+    def audit_likelihood(self, audit_networks, w, sample, predicted):  # runs in the audit pool, each pool thread has its own Network rather than sharing the replica's buffers
+        [likelihood_true, _, _, _] = self.likelihood_func(audit_networks.fnn, self.traindata, w)
+        return sample, likelihood_true, predicted
+
+    def publish(self, w, loglik, prior):  # write the current state into the row this replica owns
+        row = self.replica_state.state[self.replica_state.slot[self.replica_index]]
+        row[:self.num_param] = w
+        row[self.num_param] = loglik
+        row[self.num_param+1] = prior
+        row[self.num_param+2] = self.adapttemp
+
+    def exchange(self, parity, w, loglik, prior):  # swap with a neighbour in the even (0) or odd (1) pairs. returns the partner's (w, loglik, prior) if accepted
+        pair = self.swap_pair(parity)
+        if pair is None:
+            return None
+        lower = pair == self.replica_index
+        slot = self.replica_state.slot
+        partner = self.replica_index + 1 if lower else self.replica_index - 1
+        row = slot[self.replica_index]
+        self.publish(w, loglik, prior)
+        try:
+            timer = time.time()
+            self.swap_barriers[pair].wait(self.swap_timeout) # both states written
+            if lower:
+                partner_loglik = self.replica_state.state[slot[partner], self.num_param]
+                try:
+                    swap_prob = min(1, math.exp((1.0/self.adapttemp - 1.0/self.replica_state.state[slot[partner], self.num_param+2]) * (partner_loglik - loglik)))
+                except OverflowError as e:
+                    swap_prob = 1
+                self.replica_state.pair_attempts[pair] += 1
+                if random.uniform(0,1) < swap_prob: # the configurations stay where they are, only the slots change hands
+                    slot[self.replica_index], slot[partner] = slot[partner], slot[self.replica_index]
+                    self.replica_state.pair_accepts[pair] += 1
+            self.swap_barriers[pair].wait(self.swap_timeout) # decision written
+            swapped = slot[self.replica_index] != row
+            self.swap_idle += time.time() - timer
+        except threading.BrokenBarrierError:
+            # partner finished or died, the barrier stays broken and later rounds of this pair return straight away
+            self.swap_idle += time.time() - timer
+            return None
+        self.swap_attempts += 1
+        if swapped:
+            self.swap_accepts += 1
+            state = self.replica_state.state[slot[self.replica_index]] # the partner's row, no longer written by anyone else
+            return state[:self.num_param].copy(), state[self.num_param], state[self.num_param+1]
+        return None
+
+    def adapt_ladder(self, swap_round):  # Vousden et al. (2016): log spacings grow where a pair swaps more often than the next one, the ends stay fixed
+        attempts = self.replica_state.pair_attempts.copy()
+        accepts = self.replica_state.pair_accepts.copy()
+        new = attempts - self.ladder_attempts
+        rates = (accepts - self.ladder_accepts)/np.maximum(1.0, new)
+        self.ladder_attempts, self.ladder_accepts = attempts, accepts
+        self.swap_rates = np.where(new == 0, self.swap_rates, np.where(np.isnan(self.swap_rates), rates, (1 - self.ladder_smoothing)*self.swap_rates + self.ladder_smoothing*rates))
+        ladder = self.replica_state.temperature
+        if ladder.shape[0] < 3 or np.any(np.isnan(self.swap_rates)) or not np.isfinite(ladder[-1]):
+            return False
+        kappa = self.ladder_lag/(swap_round + self.ladder_lag*1.0)/self.ladder_time
+        spacing = np.diff(ladder[:-1]) * np.exp(kappa*(self.swap_rates[:-1] - self.swap_rates[1:])) # same update as ptemcee's _update_ladder
+        proposal = ladder[0] + np.cumsum(spacing)
+        if proposal[-1] >= ladder[-1]: # would push a rung past the hottest one
+            return False
+        ladder[1:-1] = proposal
+        return True
+
+    def stream(self, store, name, samples, row_shape=(), fill=0.0):  # a saved list under this replica's storage policy
+        first, step = 0, 1
+        if name in posterior_datasets:
+            first, step = (int(samples * self.burn_in) if self.store_burn_in is True else 0), self.store_thinning
+        return store.stream(self.temperature, name, samples, row_shape, block=self.store_block, fill=fill, first=first, step=step, skip=name in self.store_skip)
+
     def prior_likelihood(self, sigma_squared, nu_1, nu_2, w):
         h = self.topology[1]  # number hidden neurons
         d = self.topology[0]  # number input neurons
@@ -409,12 +980,35 @@ class ptReplica(multiprocessing.Process):
         log_loss = part1 - part2
         return log_loss
 
-    def run(self):
+    def swap_pair(self, parity):  # the adjacent pair this replica is in among the even (0) or odd (1) pairs, None at the ends of the ladder
+        pair = self.replica_index if self.replica_index % 2 == parity else self.replica_index - 1
+        return pair if 0 <= pair < self.replica_state.pair_attempts.shape[0] else None
+
+    def swap_parities(self, swap_round):  # pairs tried in this round, even (0) and/or odd (1)
+        return [swap_round % 2] if self.swap_scheme == "alternate" else [0, 1]
+
+    def run(self):  # one process per replica, the replica meets its neighbours itself at every swap point
+        chain = self.sample()
+        try:
+            swap_round, w, loglik, prior = next(chain)
+            while True:
+                partner = None
+                for parity in self.swap_parities(swap_round):
+                    swapped = self.exchange(parity, w, loglik, prior)
+                    if swapped is not None:
+                        partner = swapped
+                        w, loglik, prior = swapped
+                swap_round, w, loglik, prior = chain.send(partner)
+        except StopIteration:
+            pass
+
+    def sample(self):  # the chain as a generator, it stops at every swap point with its state and resumes with the partner's state, or None
         # rmse_train_file = open(self.path+'/predictions/rmse_train_chain_'+ str(self.temperature)+ '.txt')
         # rmse_test_file = open(self.path+'/predictions/rmse_test_chain_'+ str(self.temperature)+ '.txt')
         # acc_train_file = open(self.path+'/predictions/acc_train_chain_'+ str(self.temperature)+ '.txt')
         # acc_test_file = open(self.path+'/predictions/acc_test_chain_'+ str(self.temperature)+ '.txt')
 
+        startup = time.time() - self.launch_time
         #INITIALISING FOR FNN
         testsize = self.testdata.shape[0]
         trainsize = self.traindata.shape[0]
@@ -427,16 +1021,14 @@ class ptReplica(multiprocessing.Process):
         y_train = self.traindata[:,netw[0]]
 
         w_size = (netw[0] * netw[1]) + (netw[1] * netw[2]) + netw[1] + netw[2]  # num of weights and bias
-        pos_w = np.ones((samples, w_size)) #Posterior for all weights
-        s_pos_w = np.ones((samples, w_size)) #Surrogate Trainer
-        lhood_list = np.zeros((samples,1))
-        surrogate_list = np.zeros((samples ,1))
+        store = RunStore(self.path) # the saved lists are streamed to it in blocks while the chain runs
+        pos_w = self.stream(store, 'pos_w', samples, (w_size,), fill=1.0) #Posterior for all weights
         #fxtrain_samples = np.ones((samples/100, trainsize)) #Output of regression FNN for training samples
         #fxtest_samples = np.ones((samples/100, testsize)) #Output of regression FNN for testing samples
-        rmse_train  = np.zeros(samples)
-        rmse_test = np.zeros(samples)
-        acc_train = np.zeros(samples)
-        acc_test = np.zeros(samples)
+        rmse_train  = self.stream(store, 'rmse_train', samples)
+        rmse_test = self.stream(store, 'rmse_test', samples)
+        acc_train = self.stream(store, 'acc_train', samples)
+        acc_test = self.stream(store, 'acc_test', samples)
         learn_rate = 0.5
 
         naccept = 0
@@ -468,11 +1060,10 @@ class ptReplica(multiprocessing.Process):
         #accept_list = open(self.path+'/acceptlist_'+str(int(self.temperature*10))+'.txt', "a+")
         trainacc = 0
         testacc=0
-        prop_list = np.zeros((samples,w_proposal.size))
-        likeh_list = np.zeros((samples,2)) # one for posterior of likelihood and the other for all proposed likelihood
+        likeh_list = self.stream(store, 'pos_likelihood', samples, (2,)) # one for posterior of likelihood and the other for all proposed likelihood
         likeh_list[0,:] = [-100, -100] # to avoid prob in calc of 5th and 95th percentile later
-        surg_likeh_list = np.zeros((samples,3))
-        accept_list = np.zeros(samples)
+        surg_likeh_list = self.stream(store, 'surg_likelihood', samples, (3,))
+        accept_list = self.stream(store, 'accept_list', samples)
         num_accepted = 0
         is_true_lhood = True
         lhood_counter = 0
@@ -483,26 +1074,41 @@ class ptReplica(multiprocessing.Process):
         pt_samples = samples * 1# this means that PT in canonical form with adaptive temp will work till pt  samples are reached
         burnsamples = int(self.samples * self.burn_in)
         init_count = 0
-        trainset_empty = True
         surrogate_model = None
         surrogate_counter = 0
+        surrogate_current = None # tempered surrogate likelihood of w, only kept in delayed acceptance
+        da_screened_counter = 0
 
+        audit_counter = 0
+        audit_networks = threading.local()
+        def audit_worker():  # built once per pool thread, no random init so the chain's random stream is not touched from the pool
+            audit_networks.fnn = Network(self.topology, self.traindata, self.testdata, 0, False)
+        audit_pool = ThreadPool(self.audit_workers, audit_worker) # threads of this process, the audits share the replica's core
+        audit_file = open(self.path+'/posterior/surg_likelihood/audit_chain_'+ str(self.temperature)+ '.txt', 'w')
+        def record_audit(result):  # called from the pool's result thread, pairs are streamed to disk as they arrive
+            sample, likelihood_true, predicted = result
+            surg_likeh_list[sample,0] = likelihood_true
+            audit_file.write('%d %1.4f %1.4f\n' % (sample, likelihood_true, predicted))
+            audit_file.flush()
 
 
-        surr_train_set = np.zeros((1000, self.num_param+1))
 
-        self.resume_chain_event.clear()
+        if self.adapt_temperatures is True and self.replica_index == 0:
+            self.ladder_attempts = np.zeros(self.replica_state.pair_attempts.shape[0], dtype=np.int64)
+            self.ladder_accepts = np.zeros(self.replica_state.pair_accepts.shape[0], dtype=np.int64)
+            self.swap_rates = np.full(self.replica_state.pair_attempts.shape[0], np.nan) # moving average of each pair's acceptance rate
+            ladder_file = open(self.path + '/posterior/swap/ladder.txt', 'w') # sample, then the temperature of every rung
+            ladder_file.write('0 ' + ' '.join('%1.4f' % t for t in self.replica_state.temperature) + '\n')
 
+        # twice the interval, the replica fills one half while the trainer reads the other
+        surr_train_set = SampleBuffer(self.replica_state.rows[self.replica_index], self.replica_state.consumed[self.replica_index:self.replica_index+1])
 
-        count_real = 0
-
-
-        local_model_signature = 0.0
-
- 
-
-
- 
+        y_train_eval = y_train # labels that pred_train refers to, a minibatch of y_train when subsampling
+        datasets = {'pos_w': pos_w, 'rmse_train': rmse_train, 'rmse_test': rmse_test, 'acc_train': acc_train, 'acc_test': acc_test, 'surg_likelihood': surg_likeh_list, 'pos_likelihood': likeh_list, 'accept_list': accept_list}
+        if self.subsample_size > 0:
+            subsample_var = datasets['subsample_var'] = self.stream(store, 'subsample_var', samples, fill=np.nan) # variance of the likelihood estimate at each step
+            batch_size = min(trainsize, max(2, self.subsample_size if self.subsample_size >= 1 else int(self.subsample_size * trainsize))) # at least 2 rows, the variance estimate needs them
+            ref_lhoods, _ = self.pointwise_likelihood(fnn, self.traindata, w)
 
 
         for i in range(samples-1):
@@ -511,75 +1117,109 @@ class ptReplica(multiprocessing.Process):
             ratio = ((samples -i) /(samples*1.0))
             #self.adapttemp =  self.temperature
             if i < pt_samples:
-                self.adapttemp =  self.temperature #* ratio  #
+                self.adapttemp =  self.ladder_temperature #* ratio  #
             if i == pt_samples and init_count ==0: # move to MCMC canonical
                 self.adapttemp = 1
                 [likelihood, pred_train, rmsetrain, likl_without_temp] = self.likelihood_func(fnn, self.traindata, w)
                 [_, pred_test, rmsetest, likl_without_temp] = self.likelihood_func(fnn, self.testdata, w)
                 init_count = 1
 
+            surrogate_version = None
+            while True: # newest published surrogate, older versions still queued are skipped
+                try:
+                    surrogate_version = self.surrogate_model_queue.get_nowait()
+                except queue.Empty:
+                    break
+            if surrogate_version is not None:
+                # the trainer sends the weights with the likelihood scaling, nothing is loaded from disk
+                self.model_signature, surrogate_backend, minY, maxY, surrogate_weights = surrogate_version
+                self.minY[0,0] = minY[0,0]
+                self.maxY[0,0] = maxY[0,0]
+                if surrogate_model is None or surrogate_model.model != surrogate_backend:
+                    dummy_X = np.zeros((1,1))
+                    dummy_Y = np.zeros((1,1))
+                    surrogate_model = surrogate(surrogate_backend, dummy_X, dummy_Y, self.minlim_param, self.maxlim_param, self.minY, self.maxY, self.path, self.save_surrogate_data, self.surrogate_topology )
+                surrogate_model.set_weights(surrogate_weights)
+                surrogate_model.model_signature = self.model_signature
+                surrogate_current = None
+
             w_proposal = np.random.normal(w, step_w, w_size)
             ku = random.uniform(0,1)
-            if trainset_empty == True:
-                surr_train_set = np.zeros((1, self.num_param+1))
-            if ku<self.surrogate_prob and i>=self.surrogate_interval+1:
+            da_step = self.delayed_acceptance is True and surrogate_model is not None
+            if da_step:
+                # stage one: MH with the surrogate in place of the likelihood
+                if surrogate_current is None:
+                    surrogate_current, _ = surrogate_model.predict(w.reshape(1,w.shape[0]))
+                    surrogate_current = surrogate_current[0] *(1.0/self.adapttemp)
+                surrogate_proposal, nn_predict = surrogate_model.predict(w_proposal.reshape(1,w_proposal.shape[0]))
+                surrogate_proposal = surrogate_proposal[0] *(1.0/self.adapttemp)
+                prior_prop = self.prior_likelihood(sigma_squared, nu_1, nu_2, w_proposal)
+                try:
+                    stage_one_prob = min(1, math.exp(surrogate_proposal - surrogate_current + prior_prop - prior_current))
+                except OverflowError as e:
+                    stage_one_prob = 1
+                da_screened = random.uniform(0,1) >= stage_one_prob
+            if da_step and da_screened:
                 is_true_lhood = False
-                if surrogate_model == None:
-                    minmax = np.loadtxt(self.path+'/surrogate/minmax.txt')
-                    self.minY[0,0] = minmax[0]
-                    self.maxY[0,0] = minmax[1]
-                    surrogate_model = surrogate("krnn",surrogate_X.copy(),surrogate_Y.copy(), self.minlim_param, self.maxlim_param, self.minY, self.maxY, self.path, self.save_surrogate_data, self.surrogate_topology)
-                    surrogate_likelihood, nn_predict = surrogate_model.predict(w_proposal.reshape(1,w_proposal.shape[0]),False)
-                    surrogate_likelihood = surrogate_likelihood *(1.0/self.adapttemp)
-
-                elif self.surrogate_init == 0.0:
-                    surrogate_likelihood,  nn_predict = surrogate_model.predict(w_proposal.reshape(1,w_proposal.shape[0]), False)
-                    surrogate_likelihood = surrogate_likelihood *(1.0/self.adapttemp)
-                else:
-                    surrogate_likelihood,  nn_predict = surrogate_model.predict(w_proposal.reshape(1,w_proposal.shape[0]), True)
-                    surrogate_likelihood = surrogate_likelihood *(1.0/self.adapttemp)
+                likelihood_proposal = surrogate_proposal
+                likl_without_temp = surrogate_proposal*self.adapttemp
+                da_screened_counter += 1
+                surg_likeh_list[i+1,0] = np.nan
+                surg_likeh_list[i+1,1] = surrogate_proposal
+                surg_likeh_list[i+1,2] = surrogate_proposal
+                if random.uniform(0,1) < self.surrogate_audit:
+                    audit_pool.apply_async(self.audit_likelihood, (audit_networks, w_proposal.copy(), i+1, surrogate_proposal), callback=record_audit)
+                    audit_counter += 1
+            elif not da_step and ku<self.surrogate_prob and surrogate_model is not None:
+                is_true_lhood = False
+                surrogate_likelihood,  nn_predict = surrogate_model.predict(w_proposal.reshape(1,w_proposal.shape[0]))
+                surrogate_likelihood = surrogate_likelihood *(1.0/self.adapttemp)
                 likelihood_mov_ave = (surg_likeh_list[i,2] + surg_likeh_list[i-1,2]+ surg_likeh_list[i-2,2])/3
                 likelihood_proposal = (surrogate_likelihood[0] * 0.5) + (  likelihood_mov_ave * 0.5)
-                if self.compare_surrogate is True:
-                    [likelihood_proposal_true, pred_train, rmsetrain, likl_without_temp] = self.likelihood_func(fnn, self.traindata, w_proposal)
-                else:
-                    likelihood_proposal_true = 0
-                #print ('\nSample : ', i, ' Chain :', self.adapttemp, ' -A', likelihood_proposal_true, ' vs. P ',  likelihood_proposal, ' ---- nnPred ', nn_predict, self.minY, self.maxY )
+                #print ('\nSample : ', i, ' Chain :', self.adapttemp, ' vs. P ',  likelihood_proposal, ' ---- nnPred ', nn_predict, self.minY, self.maxY )
+                likl_without_temp = likelihood_proposal*self.adapttemp
                 surrogate_counter += 1
-                surg_likeh_list[i+1,0] =  likelihood_proposal_true
+                surg_likeh_list[i+1,0] = np.nan # filled in by the audit pool if this step is audited
                 surg_likeh_list[i+1,1] = likelihood_proposal
                 surg_likeh_list[i+1,2] = likelihood_mov_ave
+                if random.uniform(0,1) < self.surrogate_audit:
+                    audit_pool.apply_async(self.audit_likelihood, (audit_networks, w_proposal.copy(), i+1, likelihood_proposal), callback=record_audit)
+                    audit_counter += 1
             else:
                 is_true_lhood = True
-                trainset_empty = False
                 surg_likeh_list[i+1,1] =  np.nan
-                [likelihood_proposal, pred_train, rmsetrain, likl_without_temp] = self.likelihood_func(fnn, self.traindata, w_proposal)
-                [_, pred_test, rmsetest, likl_without_temp_] = self.likelihood_func(fnn, self.testdata, w_proposal)
-                likl_wo_temp = np.array([likl_without_temp])
-                X, Y = w_proposal,likl_wo_temp
-                X = X.reshape(1, X.shape[0])
-                Y = Y.reshape(1, Y.shape[0])
-                param_train = np.concatenate([X, Y],axis=1)
-                surr_train_set = np.vstack((surr_train_set, param_train))
+                if self.subsample_size > 0: # test set is only evaluated if the proposal is accepted
+                    [likelihood_proposal, pred_train, rmsetrain, likl_without_temp, subsample_var[i+1], batch] = self.subsample_likelihood_func(fnn, self.traindata, w_proposal, ref_lhoods, batch_size)
+                    y_train_eval = y_train[batch]
+                else:
+                    [likelihood_proposal, pred_train, rmsetrain, likl_without_temp] = self.likelihood_func(fnn, self.traindata, w_proposal)
+                    [_, pred_test, rmsetest, likl_without_temp_] = self.likelihood_func(fnn, self.testdata, w_proposal)
+                surr_train_set.append(w_proposal, likl_without_temp)
                 surg_likeh_list[i+1,0] = likelihood_proposal
                 surg_likeh_list[i+1,2] = likelihood_proposal
-
-                surr_train_set[count_real, :] = param_train
-                count_real = count_real +1
+                if da_step:
+                    surg_likeh_list[i+1,1] = surrogate_proposal
  
 
             prior_prop = self.prior_likelihood(sigma_squared, nu_1, nu_2, w_proposal)  # takes care of the gradients
-            diff_likelihood = likelihood_proposal -   likelihood_copy # (lhood_list[i,]  /self.adapttemp)  #
+            diff_likelihood = likelihood_proposal -   likelihood_copy
             diff_prior = prior_prop - prior_current
             try:
                 mh_prob = min(1, math.exp(diff_likelihood  + diff_prior))
             except OverflowError as e:
                 mh_prob = 1
+            if da_step:
+                # stage two corrects for the surrogate error, the chain still targets the true posterior
+                if da_screened:
+                    mh_prob = 0
+                else:
+                    try:
+                        mh_prob = min(1, math.exp(diff_likelihood - (surrogate_proposal - surrogate_current)))
+                    except OverflowError as e:
+                        mh_prob = 1
             accept_list[i+1] = naccept
             #likeh_list[i+1,0] = surrogate_var
-            #prop_list[i+1,] = v_proposal
             u = random.uniform(0, 1)
-            prop_list[i+1,] = w_proposal
             likeh_list[i+1,0] = likl_without_temp
             if u < mh_prob:
                 naccept  =  naccept + 1
@@ -588,18 +1228,20 @@ class ptReplica(multiprocessing.Process):
                 prior_current = prior_prop
                 w = w_proposal
                 pos_w[i + 1,] = w_proposal
+                if da_step:
+                    surrogate_current = surrogate_proposal
                 if is_true_lhood is  True:
-                    lhood_list[i+1,] = (likelihood*self.adapttemp)
+                    if self.subsample_size > 0:
+                        [_, pred_test, rmsetest, _] = self.likelihood_func(fnn, self.testdata, w_proposal)
                     #fxtrain_samples[i + 1,] = pred_train
                     #fxtest_samples[i + 1,] = pred_test
                     rmse_train[i + 1,] = rmsetrain
                     rmse_test[i + 1,] = rmsetest
-                    acc_train[i+1,] = self.accuracy(pred_train, y_train )
+                    acc_train[i+1,] = self.accuracy(pred_train, y_train_eval )
                     acc_test[i+1,] = self.accuracy(pred_test, y_test )
                     lhood_counter = lhood_counter + 1
                     print (i, self.adapttemp, lhood_counter ,   likelihood ,  diff_likelihood ,  diff_prior, acc_train[i+1,], acc_test[i+1,], self.adapttemp, 'accepted')
                 else:
-                    lhood_list[i+1,] = np.inf
                     #fxtrain_samples[i + 1,] = np.inf
                     #fxtest_samples[i + 1,] = np.inf
                     rmse_train[i + 1,] = np.inf
@@ -617,7 +1259,6 @@ class ptReplica(multiprocessing.Process):
             else:
                 pos_w[i+1,] = pos_w[i,]
                 if is_true_lhood is True:
-                    lhood_list[i+1,] = (likelihood_proposal*self.adapttemp)
                     #fxtrain_samples[i + 1,] = fxtrain_samples[i,]
                     #fxtest_samples[i + 1,] = fxtest_samples[i,]
                     rmse_train[i + 1,] =   rmse_train[i,]
@@ -627,7 +1268,6 @@ class ptReplica(multiprocessing.Process):
                     reject_counter = reject_counter + 1
                     print (i,lhood_counter ,   likelihood,   acc_train[lhood_counter,], acc_test[lhood_counter,],  self.adapttemp, 'rejected  true-lhood ')
                 else:
-                    lhood_list[i+1,] = np.inf
                     #fxtrain_samples[i + 1,] = np.inf
                     #fxtest_samples[i + 1,] = np.inf
                     rmse_train[i + 1,] = np.inf
@@ -640,39 +1280,46 @@ class ptReplica(multiprocessing.Process):
                     acc_test[i+1,] =  acc_test[lhood_counter,] '''
                     reject_counter_inf = reject_counter_inf + 1
                     print (i,lhood_counter ,   likelihood, self.adapttemp, rmsetrain, rmsetest, acc_train[i+1,], acc_test[i+1,],  'accepted surr ')
-            #SWAPPING PREP
-            '''if i%self.swap_interval == 0 and i != 0:
-                print("\n\nSample:{}\n\n".format(i))
-                param = np.concatenate([w, np.asarray([eta]).reshape(1), np.asarray([likelihood*self.adapttemp]),np.asarray([self.adapttemp]),np.asarray([i])])
-                # add parameters to the swap param queue and surrogate params queue
-                self.parameter_queue.put(param)
-                self.surrogate_parameter_queue.put(surr_train_set)
-                # Pause the chain execution and signal main process
-                self.pause_chain_event.set()
-                print("Temperature: {} waiting for swap and surrogate training complete signal. Event: {}".format(self.temperature, self.pause_chain_event.is_set()))
-                # Wait for the main process to complete the swap and surrogate training
-                self.resume_chain_event.clear()
-                self.resume_chain_event.wait() 
-                result =  self.parameter_queue.get()
-                w= result[0:w.size]
-                
-                #eta = result[w.size]
-                #likelihood = result[w.size+1]/self.adapttemp
-                model_sign = np.loadtxt(self.path+'/surrogate/model_signature.txt')
-                self.model_signature = model_sign
-                #print("model_signature updated")
-                if self.model_signature==1.0:
-                    minmax = np.loadtxt(self.path+'/surrogate/minmax.txt')
-                    self.minY[0,0] = minmax[0]
-                    self.maxY[0,0] = minmax[1]
-                    # # print 'min ', self.minY, ' max ', self.maxY
-                    dummy_X = np.zeros((1,1))
-                    dummy_Y = np.zeros((1,1))
-                    surrogate_model = surrogate("krnn", dummy_X, dummy_Y, self.minlim_param, self.maxlim_param, self.minY, self.maxY, self.path, self.save_surrogate_data, self.surrogate_topology )
-                self.surrogate_init,  nn_predict  = surrogate_model.predict(w_proposal.reshape(1,w_proposal.shape[0]), False)
-                # print("Surrogate init ", self.surrogate_init , " - should be -1")
-                del surr_train_set
-                trainset_empty = True'''
+            if self.subsample_size > 0 and i%self.subsample_refresh == 0 and i != 0:
+                # move the control variate to the current state, its likelihood becomes exact again
+                ref_lhoods, _ = self.pointwise_likelihood(fnn, self.traindata, w)
+                likelihood = np.sum(ref_lhoods)/self.adapttemp
+                likelihood_copy = likelihood
+
+            #SWAPPING
+            if i%self.swap_interval == 0 and i != 0:
+                swap_round = int(i/self.swap_interval)
+                if self.adapt_temperatures is True:
+                    if self.replica_index == 0 and i < burnsamples and self.adapt_ladder(swap_round):
+                        ladder_file.write(str(i) + ' ' + ' '.join('%1.4f' % t for t in self.replica_state.temperature) + '\n')
+                    temperature = self.replica_state.temperature[self.replica_index]
+                    if temperature != self.ladder_temperature: # move to the new rung, the tempered likelihood is rescaled rather than recomputed
+                        likelihood = likelihood*self.ladder_temperature/temperature
+                        likelihood_copy = likelihood
+                        self.ladder_temperature = temperature
+                        self.adapttemp = temperature
+                        surrogate_current = None
+                partner = yield swap_round, w, likelihood*self.adapttemp, prior_current
+                if partner is not None:
+                    w, likelihood, prior_current = partner
+                    likelihood = likelihood/self.adapttemp
+                    likelihood_copy = likelihood
+                    surrogate_current = None # the partner may have scored it with another surrogate version
+                    # the stored row moves with the chain, rejected steps copy it forward from here
+                    [_, fx_train_partner, rmse_train_partner, _] = self.likelihood_func(fnn, self.traindata, w)
+                    [_, fx_test_partner, rmse_test_partner, _] = self.likelihood_func(fnn, self.testdata, w)
+                    pos_w[i+1,] = w
+                    rmse_train[i+1,] = rmse_train_partner
+                    rmse_test[i+1,] = rmse_test_partner
+                    acc_train[i+1,] = self.accuracy(fx_train_partner, y_train)
+                    acc_test[i+1,] = self.accuracy(fx_test_partner, y_test)
+                    if self.subsample_size > 0: # the partner's estimate was against its own reference, restart from the exact likelihood at the new one
+                        ref_lhoods, _ = self.pointwise_likelihood(fnn, self.traindata, w)
+                        likelihood = np.sum(ref_lhoods)/self.adapttemp
+                        likelihood_copy = likelihood
+
+            if i%self.store_block == 0 and i != 0: # readers can tell how far the streamed lists are on disk
+                store.write_chain(self.temperature, datasets, complete=False, samples=samples, replica_index=self.replica_index)
 
             if i%self.surrogate_interval == 0 and i != 0:
                 print("\n\nSample:{}\n\n".format(i))
@@ -680,108 +1327,371 @@ class ptReplica(multiprocessing.Process):
                 # add parameters to the swap param queue and surrogate params queue
                 #self.parameter_queue.put(param)
 
-                surr_train = surr_train_set[1:count_real, :]
- 
-
                 #self.surrogate_parameter_queue.put(all_param)
 
-                self.surrogate_parameter_queue.put(surr_train)
-                # Pause the chain execution and signal main process
-                self.pause_chain_event.set()
-                print("Temperature: {} waiting for swap and surrogate training complete signal. Event: {}".format(self.temperature, self.pause_chain_event.is_set()))
-                # Wait for the main process to complete the swap and surrogate training
-                self.resume_chain_event.clear()
-                self.resume_chain_event.wait()
-                # retrieve parameters fom queues if it has been swapped
-                ''' comment below 2 lines to stop swap '''
-                #result =  self.parameter_queue.get()
-                #v_current= result[0:v_current.size]
-                
-                #eta = result[w.size]
-                #likelihood = result[w.size+1]/self.adapttemp
-
-                model_sign = np.loadtxt(self.path+'/surrogate/model_signature.txt')
-                self.model_signature = model_sign
-                #print("model_signature updated")
-
-                if self.model_signature==1.0:
-                    minmax = np.loadtxt(self.path+'/surrogate/minmax.txt')
-                    self.minY[0,0] = minmax[0]
-                    self.maxY[0,0] = minmax[1]
-                    # # print 'min ', self.minY, ' max ', self.maxY
-                    dummy_X = np.zeros((1,1))
-                    dummy_Y = np.zeros((1,1))
-                    surrogate_model = surrogate("krnn", dummy_X, dummy_Y, self.minlim_param, self.maxlim_param, self.minY, self.maxY, self.path, self.save_surrogate_data, self.surrogate_topology )
+                # hand the batch to the trainer and keep sampling, the new model is picked up whenever it is published
+                first, count = surr_train_set.take()
+                self.surrogate_parameter_queue.put([self.temperature, self.replica_index, first, count]) # the rows stay in shared memory, only their range is queued
 
-                    local_model_signature = local_model_signature +1
 
- 
+        self.publish(w, likelihood*self.adapttemp, prior_current) # final state stays readable in the shared block
+        self.surrogate_parameter_queue.put(None) # tells the trainer this replica is done
 
-                self.surrogate_init,  nn_predict  = surrogate_model.predict(w_proposal.reshape(1,w_proposal.shape[0]), False) 
+        accept_ratio = naccept / (samples * 1.0) * 100
+        print("Temperature: {} accept ratio: {}".format(self.temperature, accept_ratio))
+        if self.delayed_acceptance is True:
+            print("Temperature: {} proposals screened out by the surrogate: {}".format(self.temperature, da_screened_counter))
+        print("Temperature: {} swaps accepted {} of {}, {:.2f} s idle waiting for partners".format(self.temperature, self.swap_accepts, self.swap_attempts, self.swap_idle))
+        if self.adapt_temperatures is True and self.replica_index == 0:
+            ladder_file.close()
+        file_name = self.path + '/posterior/swap/chain_' + str(self.temperature) + '.txt'
+        np.savetxt(file_name, [self.swap_attempts, self.swap_accepts, self.swap_idle], fmt='%1.4f')
+        print("Temperature: {} surrogate buffer: peak {} of {} rows ({:.1f}%), {:.1f} rows per batch, {} dropped".format(self.temperature, surr_train_set.peak, surr_train_set.capacity, 100*surr_train_set.utilisation(), surr_train_set.handed/max(1.0, surr_train_set.handoffs), surr_train_set.dropped))
+
+
+
+
+        audit_pool.close()
+        audit_pool.join()
+        audit_file.close()
+        print("Temperature: {} surrogate steps: {} audited: {}".format(self.temperature, surrogate_counter + da_screened_counter, audit_counter))
+
+        # after the audit pool is joined, it fills in surg_likeh_list
+        store.write_chain(self.temperature, datasets, accept_ratio=accept_ratio, samples=samples, replica_index=self.replica_index)
+        if self.subsample_size > 0 and 'subsample_var' not in self.store_skip:
+            print("Temperature: {} minibatch of {} rows, mean likelihood estimator variance: {}".format(self.temperature, batch_size, np.nanmean(store.read(self.temperature, 'subsample_var'))))
+        peak_rss, private_rss, shared_rss = memory_usage()
+        print("Temperature: {} start-up {:.3f} s, peak RSS {:.1f} MB ({:.1f} MB private, {:.1f} MB shared memory)".format(self.temperature, startup, peak_rss, private_rss, shared_rss))
+        file_name = self.path + '/posterior/resources/chain_' + str(self.temperature) + '.txt' # start-up s, peak, private and shared memory RSS in MB
+        np.savetxt(file_name, [startup, peak_rss, private_rss, shared_rss], fmt='%1.4f')
+        print("Temperature {} chain dead!".format(self.temperature))
 
-                #del surr_train_set
-                trainset_empty = True 
 
+class ReplicaWorker(multiprocessing.Process): # advances a group of replicas in blocks of swap_interval samples, the main process swaps between blocks
 
+    def __init__(self, replicas, block_barrier):
+        multiprocessing.Process.__init__(self)
+        self.replicas = replicas
+        self.block_barrier = block_barrier # all workers and the main process
 
-                np.savetxt(self.path+'/surrogate/traindata_'+ str(int(self.temperature*10)) +'_'+str(local_model_signature)    +'_.txt', surr_train_set)
+    def run(self):
+        chains = [replica.sample() for replica in self.replicas]
+        states = [next(chain, None) for chain in chains]
+        while states[0] is not None: # every replica has the same swap points, so they all stop together
+            rows = []
+            for replica, (swap_round, w, loglik, prior) in zip(self.replicas, states):
+                replica.publish(w, loglik, prior)
+                rows.append(replica.replica_state.slot[replica.replica_index])
+            try:
+                timer = time.time()
+                self.block_barrier.wait(self.replicas[0].swap_timeout) # states published
+                self.block_barrier.wait(self.replicas[0].swap_timeout) # swaps decided
+                idle = time.time() - timer
+            except threading.BrokenBarrierError:
+                print("Replica worker stopped, the block barrier broke")
+                return
+            for k, replica in enumerate(self.replicas):
+                slot = replica.replica_state.slot[replica.replica_index]
+                replica.swap_idle += idle
+                replica.swap_attempts += sum(1 for parity in replica.swap_parities(states[k][0]) if replica.swap_pair(parity) is not None)
+                partner = None
+                if slot != rows[k]:
+                    replica.swap_accepts += 1
+                    state = replica.replica_state.state[slot]
+                    partner = state[:replica.num_param].copy(), state[replica.num_param], state[replica.num_param+1]
+                try:
+                    states[k] = chains[k].send(partner)
+                except StopIteration:
+                    states[k] = None
+
+class ReplicaBatch: # all replicas in one process as rows of an (R, num_param) array, proposals, likelihoods, MH and swaps are vectorised over the rows
+
+    def __init__(self, w, temperatures, samples, traindata, testdata, topology, swap_interval, swap_scheme, path, replica_state, burn_in, store_burn_in, store_thinning, store_skip):
+        self.w = w
+        self.temperatures = temperatures
+        self.num_chains = len(temperatures)
+        self.num_param = w.shape[0]
+        self.samples = samples
+        self.traindata = traindata
+        self.testdata = testdata
+        self.topology = topology
+        self.swap_interval = swap_interval
+        self.swap_scheme = swap_scheme
+        self.path = path
+        self.replica_state = replica_state # only its per-pair swap counters are used
+        self.store_first = int(samples * burn_in) if store_burn_in is True else 0 # storage policy of ptReplica.stream, posterior_datasets only keep these rows
+        self.store_thinning = store_thinning
+        self.store_skip = store_skip
+        self.step_w = 0.025
+        self.sigma_squared = 25
+
+    def prior_likelihood(self, W):  # ptReplica.prior_likelihood for every row
+        h = self.topology[1]
+        d = self.topology[0]
+        part1 = -1 * ((d * h + h + self.topology[2]+h*self.topology[2]) / 2) * np.log(self.sigma_squared)
+        return part1 - np.sum(np.square(W), axis=1) / (2 * self.sigma_squared)
+
+    def likelihood(self, fnn, data, W):  # untempered log-likelihood, rmse and accuracy of every row in one pass over the data
+        lhood, fx, rmse = stacked_likelihood(fnn, data, W, self.topology)
+        return lhood, rmse, 100*np.mean(fx == data[:, self.topology[0]], axis=1)
 
+    def run(self):
+        R = self.num_chains
+        samples = self.samples
+        T = np.asarray(self.temperatures)
+        fnn = Network(self.topology, self.traindata, self.testdata, 0.5)
+
+        W = np.tile(self.w, (R, 1))
+        lhood, rmse_tr, acc_tr = self.likelihood(fnn, self.traindata, W)
+        _, rmse_te, acc_te = self.likelihood(fnn, self.testdata, W)
+        prior = self.prior_likelihood(W)
+
+        # same layout as the per replica lists in ptReplica.run, one page per replica
+        kept = len(range(self.store_first, samples, self.store_thinning)) # rows of posterior_datasets
+        pos_w = np.ones((R, kept, self.num_param))
+        rmse_train = np.zeros((R, kept))
+        rmse_test = np.zeros((R, kept))
+        acc_train = np.zeros((R, kept))
+        acc_test = np.zeros((R, kept))
+        likeh_list = np.zeros((R, samples, 2))
+        likeh_list[:, 0, :] = [-100, -100]
+        surg_likeh_list = np.zeros((R, samples, 3))
+        accept_list = np.zeros((R, samples))
+        naccept = np.zeros(R)
+        swap_attempts = np.zeros(R)
+        swap_accepts = np.zeros(R)
 
-                #surr_train_set = np.zeros((1, self.num_param+1))
+        for i in range(samples-1):
+            W_proposal = W + np.random.normal(0, self.step_w, W.shape)
+            lhood_proposal, rmse_tr_proposal, acc_tr_proposal = self.likelihood(fnn, self.traindata, W_proposal)
+            _, rmse_te_proposal, acc_te_proposal = self.likelihood(fnn, self.testdata, W_proposal)
+            prior_proposal = self.prior_likelihood(W_proposal)
+            accept_list[:, i+1] = naccept
+            accepted = np.log(np.random.uniform(0, 1, R)) < (lhood_proposal - lhood)/T + prior_proposal - prior
+            W[accepted] = W_proposal[accepted]
+            for current, proposal in ((lhood, lhood_proposal), (prior, prior_proposal), (rmse_tr, rmse_tr_proposal), (rmse_te, rmse_te_proposal), (acc_tr, acc_tr_proposal), (acc_te, acc_te_proposal)):
+                current[accepted] = proposal[accepted]
+            naccept += accepted
+            if i+1 >= self.store_first and (i+1 - self.store_first) % self.store_thinning == 0:
+                row = (i+1 - self.store_first)//self.store_thinning
+                pos_w[:, row] = W
+                rmse_train[:, row] = rmse_tr
+                rmse_test[:, row] = rmse_te
+                acc_train[:, row] = acc_tr
+                acc_test[:, row] = acc_te
+            likeh_list[:, i+1, 0] = lhood_proposal
+            surg_likeh_list[:, i+1, 0] = lhood_proposal/T
+            surg_likeh_list[:, i+1, 1] = np.nan # no surrogate in this engine
+            surg_likeh_list[:, i+1, 2] = lhood_proposal/T
+
+            if i%self.swap_interval == 0 and i != 0:
+                swap_round = int(i/self.swap_interval)
+                for parity in ([swap_round % 2] if self.swap_scheme == "alternate" else [0, 1]):
+                    lower = np.arange(parity, R-1, 2)
+                    upper = lower + 1
+                    swapped = np.log(np.random.uniform(0, 1, lower.shape[0])) < (1.0/T[lower] - 1.0/T[upper]) * (lhood[upper] - lhood[lower])
+                    order = np.arange(R)
+                    order[lower[swapped]] = upper[swapped]
+                    order[upper[swapped]] = lower[swapped]
+                    W, lhood, prior, rmse_tr, rmse_te, acc_tr, acc_te = [a[order] for a in (W, lhood, prior, rmse_tr, rmse_te, acc_tr, acc_te)]
+                    self.replica_state.pair_attempts[lower] += 1
+                    self.replica_state.pair_accepts[lower[swapped]] += 1
+                    swap_attempts[lower] += 1
+                    swap_attempts[upper] += 1
+                    swap_accepts[lower[swapped]] += 1
+                    swap_accepts[upper[swapped]] += 1
+
+        for k in range(R):
+            temperature = str(self.temperatures[k])
+            accept_ratio = naccept[k] / (samples * 1.0) * 100
+            print("Temperature: {} accept ratio: {}".format(self.temperatures[k], accept_ratio))
+            np.savetxt(self.path + '/posterior/swap/chain_' + temperature + '.txt', [swap_attempts[k], swap_accepts[k], 0.0], fmt='%1.4f')
+            datasets = {'pos_w': pos_w[k], 'rmse_train': rmse_train[k], 'rmse_test': rmse_test[k], 'acc_train': acc_train[k], 'acc_test': acc_test[k], 'surg_likelihood': surg_likeh_list[k], 'pos_likelihood': likeh_list[k], 'accept_list': accept_list[k]}
+            datasets = dict((name, datasets[name]) for name in datasets if name not in self.store_skip)
+            stored = dict((name, (self.store_first, self.store_thinning)) for name in posterior_datasets)
+            RunStore(self.path).write_chain(self.temperatures[k], datasets, stored=stored, accept_ratio=accept_ratio, samples=samples, replica_index=k)
+
+
+class SurrogateArchive: # fixed budget store of (w, likelihood) pairs over the whole run, reservoir sampled per temperature
+
+    def __init__(self, num_param, capacity, num_strata):
+        self.stratum_capacity = max(1, int(capacity/num_strata))
+        size = self.stratum_capacity*num_strata
+        self.X = np.zeros((size, num_param), dtype=np.float32)
+        self.Y = np.zeros(size, dtype=np.float32)
+        self.filled = np.zeros(num_strata, dtype=int)
+        self.seen = np.zeros(num_strata, dtype=int)
+        self.strata = {} # temperature -> stratum
+
+    def add(self, temperature, batch):
+        stratum = self.strata.setdefault(temperature, len(self.strata))
+        X = batch[:, :-1].astype(np.float32)
+        Y = batch[:, -1]
+        for x, y in zip(X, Y):
+            if not np.isfinite(y): # replicas only send proposals they evaluated on the true likelihood, so there are no repeated rows to collapse
+                continue
+            self.seen[stratum] += 1
+            if self.filled[stratum] < self.stratum_capacity:
+                slot = stratum*self.stratum_capacity + self.filled[stratum]
+                self.filled[stratum] += 1
+            else: # reservoir sampling keeps a uniform sample of everything this temperature has sent
+                j = np.random.randint(self.seen[stratum])
+                if j >= self.stratum_capacity:
+                    continue
+                slot = stratum*self.stratum_capacity + j
+            self.X[slot] = x
+            self.Y[slot] = y
+
+    def data(self):
+        idx = np.concatenate([np.arange(s*self.stratum_capacity, s*self.stratum_capacity + self.filled[s]) for s in range(len(self.filled))])
+        return self.X[idx].astype(np.float64), self.Y[idx].astype(np.float64).reshape(-1, 1)
+
+    def save(self, file_name):
+        X, Y = self.data()
+        np.savez(file_name, X=X.astype(np.float32), Y=Y.astype(np.float32), filled=self.filled, seen=self.seen)
+
+
+class SurrogateTrainer(multiprocessing.Process): # trains in the background on the batches replicas send and publishes numbered model versions
+
+    def __init__(self, num_param, num_chains, minlim_param, maxlim_param, path, save_surrogate_data, surrogate_topology, surrogate_backend, surrogate_mse_target, surrogate_incremental, surrogate_archive_size, surrogate_data_queue, surrogate_model_queues, replica_state):
+        multiprocessing.Process.__init__(self)
+        self.num_param = num_param
+        self.num_chains = num_chains
+        self.minlim_param = minlim_param
+        self.maxlim_param = maxlim_param
+        self.path = path
+        self.save_surrogate_data = save_surrogate_data
+        self.surrogate_topology = surrogate_topology
+        self.surrogate_data_queue = surrogate_data_queue # shared by all replicas, None marks a finished replica
+        self.surrogate_model_queues = surrogate_model_queues
+        self.replica_state = replica_state # the training rows are read from the replicas' rings in here
+        self.minY = np.zeros((1,1))
+        self.maxY = np.ones((1,1))
 
-                count_real = 0
+        self.model_signature = 0.0
+        self.surrogate_model = None # kept in memory between intervals and retrained on the new data
+        self.surrogate_backend = surrogate_backend # "krnn", one of surrogate_backends or "auto"
+        self.surrogate_mse_target = surrogate_mse_target # validation mse on the normalised likelihood that "auto" has to meet
+        self.surrogate_incremental = surrogate_incremental # after the first interval only the new batch is added to the model instead of a full refit
+        self.archive = SurrogateArchive(num_param, surrogate_archive_size, num_chains)
 
+    def run(self):
+        finished = 0
+        batches = []
+        received = 0 # messages of this round, an empty batch still counts as that replica's part
+        while finished < self.num_chains:
+            # one version per round, i.e. once every replica still running has sent its batch for the interval
+            message = self.surrogate_data_queue.get()
+            if message is None:
+                finished += 1
+            else:
+                received += 1
+                temperature, index, first, count = message
+                if count > 0:
+                    batch = self.replica_state.batch(index, first, count)
+                    self.replica_state.consumed[index] = first + count # the replica may write over these rows now
+                    self.archive.add(temperature, batch)
+                    batches.append(batch)
+            if received > 0 and received >= self.num_chains - finished and finished < self.num_chains:
+                if len(batches) > 0: # a round where every batch was empty publishes no version
+                    self.train(np.concatenate(batches, axis=0))
+                batches = []
+                received = 0
+        for index in range(self.num_chains):
+            self.surrogate_model_queues[index].cancel_join_thread() # replicas are done, the last version has no reader
+        print("Surrogate trainer done, {} versions published, archive holds {} of {} rows sent".format(int(self.model_signature), np.sum(self.archive.filled), np.sum(self.archive.seen)))
+
+    def train(self,params):
+        #X = params[:,:self.num_param]
+        #Y = params[:,self.num_param].reshape(X.shape[0],1)
+        #indices = np.where(Y==np.inf)[0]
+        #X = np.delete(X, indices, axis=0)
+        #Y = np.delete(Y,indices, axis=0)
+        #surrogate_model = surrogate("nn",X,Y,self.path)
+        #surrogate_model.train()
 
-        parameters= np.concatenate([w, np.asarray([eta]).reshape(1), np.asarray([likelihood]), np.asarray([self.adapttemp]), np.asarray([i])])
-        self.parameter_queue.put(parameters)
-        parameters = np.concatenate([s_pos_w[i-self.surrogate_interval:i,:],lhood_list[i-self.surrogate_interval:i,:]],axis=1)
-        self.surrogate_parameter_queue.put(parameters)
-
-        accept_ratio = naccept / (samples * 1.0) * 100
-        print("Temperature: {} accept ratio: {}".format(self.temperature, accept_ratio))
 
+        timer = time.time()
+        X = params[:,:self.num_param]
+        Y = params[:,self.num_param].reshape(X.shape[0],1)
 
+        incremental = self.surrogate_incremental is True and self.surrogate_model is not None
 
+        if not incremental: # refit on the archive, i.e. on the whole history rather than this round only. in incremental mode the scaling has to stay fixed
+            X, Y = self.archive.data()
+            for i in range(Y.shape[1]):
+                min_Y = min(Y[:,i])
+                max_Y = max(Y[:,i])
+                self.minY[0,i] =   min_Y * 2
+                self.maxY[0,i] = -1#max_Y
 
-        file_name = self.path+'/posterior/pos_w/'+'chain_'+ str(self.temperature)+ '.txt'
-        np.savetxt(file_name,pos_w )
-        '''file_name = self.path+'/predictions/fxtrain_samples_chain_'+ str(self.temperature)+ '.txt'
-        np.savetxt(file_name, fxtrain_samples, fmt='%1.2f')
-        file_name = self.path+'/predictions/fxtest_samples_chain_'+ str(self.temperature)+ '.txt'
-        np.savetxt(file_name, fxtest_samples, fmt='%1.2f')        '''
-        file_name = self.path+'/predictions/rmse_test_chain_'+ str(self.temperature)+ '.txt'
-        np.savetxt(file_name, rmse_test, fmt='%1.2f')
-        file_name = self.path+'/predictions/rmse_train_chain_'+ str(self.temperature)+ '.txt'
-        np.savetxt(file_name, rmse_train, fmt='%1.2f')
+        self.model_signature += 1.0
 
+        Y= self.normalize_likelihood(Y)
+        indices = np.where(Y==np.inf)[0]
+        X = np.delete(X, indices, axis=0)
+        Y = np.delete(Y,indices, axis=0)
+        if self.surrogate_model is None:
+            if self.surrogate_backend == "auto":
+                self.surrogate_backend = self.select_surrogate_backend(X, Y)
+            self.surrogate_model = surrogate(self.surrogate_backend, X , Y , self.minlim_param, self.maxlim_param, self.minY, self.maxY, self.path, self.save_surrogate_data, self.surrogate_topology )
+        if incremental:
+            self.surrogate_model.partial_fit(X, Y, self.model_signature)
+        else:
+            self.surrogate_model.X = X
+            self.surrogate_model.Y = Y
+            self.surrogate_model.train(self.model_signature)
+
+        if self.save_surrogate_data is True:
+            self.archive.save(self.path+'/surrogate/learnsurrogate_data/archive.npz')
+
+        weights = self.surrogate_model.get_weights()
+        for index in range(self.num_chains):
+            self.surrogate_model_queues[index].put([self.model_signature, self.surrogate_backend, self.minY.copy(), self.maxY.copy(), weights])
+        print("Surrogate version {} published, trained on {} rows in {} s".format(self.model_signature, X.shape[0], time.time() - timer))
+
+    def select_surrogate_backend(self, X, Y):  # fastest lightweight backend meeting surrogate_mse_target on a 10% hold-out, keras only if none does
+        idx = np.random.permutation(X.shape[0])
+        n_val = max(1, int(0.1*X.shape[0]))
+        val, fit = idx[:n_val], idx[n_val:]
+        best = None
+        for name in surrogate_backends:
+            backend = surrogate_backends[name](self.surrogate_topology)
+            timer = time.time()
+            backend.train(X[fit], Y[fit])
+            mse = np.mean((backend.predict(X[val]) - Y[val].ravel())**2)
+            cost = time.time() - timer
+            print("Surrogate backend {}: validation mse {} in {} s".format(name, mse, cost))
+            if mse <= self.surrogate_mse_target and (best is None or cost < best[1]):
+                best = (name, cost)
+        name = best[0] if best is not None else "krnn"
+        print("Surrogate backend selected: {}".format(name))
+        return name
 
-        file_name = self.path+'/predictions/acc_test_chain_'+ str(self.temperature)+ '.txt'
-        np.savetxt(file_name, acc_test, fmt='%1.2f')
-        file_name = self.path+'/predictions/acc_train_chain_'+ str(self.temperature)+ '.txt'
-        np.savetxt(file_name, acc_train, fmt='%1.2f')
 
-        #surg_likeh_list  = surg_likeh_list[:,0:1]
+    def normalize_likelihood(self, Y):
+        for i in range(Y.shape[1]):
+            if self.model_signature == 1.0:
+                min_Y = min(Y[:,i])
+                max_Y = max(Y[:,i])
+                # self.minY[0,i] = 1 #For Tau Squared
+                # self.maxY[0,i] = max_Y
 
 
-        file_name = self.path+'/posterior/surg_likelihood/chain_'+ str(self.temperature)+ '.txt'
-        np.savetxt(file_name,surg_likeh_list, fmt='%1.4f')
+                # min -115 and max -96
+                self.maxY[0,i] = -1 #max_Y
+                self.minY[0,i] =  min_Y * 2
 
-        file_name = self.path+'/posterior/pos_likelihood/chain_'+ str(self.temperature)+ '.txt'
-        np.savetxt(file_name,likeh_list, fmt='%1.4f')
+            # Y[:,i] = ([:,i] - min_Y)/(max_Y - min_Y)
 
+            Y[:,i] = (Y[:,i] - self.minY[0,0])/(self.maxY[0,0]-self.minY[0,0])
 
-        file_name = self.path + '/posterior/accept_list/chain_' + str(self.temperature) + '_accept.txt'
-        np.savetxt(file_name, [accept_ratio], fmt='%1.4f')
+        return Y
 
-        file_name = self.path + '/posterior/accept_list/chain_' + str(self.temperature) + '.txt'
-        np.savetxt(file_name, accept_list, fmt='%1.4f')
-        print("Temperature {} chain dead!".format(self.temperature))
-        self.pause_chain_event.set()
-        return
 
 class ParallelTempering:
 
-    def __init__(self, use_surrogate,  use_langevin_gradients, learn_rate,  save_surrogate_data, traindata, testdata, topology, num_chains, maxtemp, NumSample, swap_interval, surrogate_interval, surrogate_prob, path, path_db, surrogate_topology):
+    def __init__(self, use_surrogate,  use_langevin_gradients, learn_rate,  save_surrogate_data, traindata, testdata, topology, num_chains, maxtemp, NumSample, swap_interval, surrogate_interval, surrogate_prob, path, path_db, surrogate_topology, subsample_size, delayed_acceptance, surrogate_audit, surrogate_backend, surrogate_mse_target, surrogate_incremental, surrogate_archive_size, swap_scheme, adapt_temperatures, replica_workers, replica_batch, store_burn_in, store_thinning, store_skip):
         #FNN Chain variables
         self.traindata = traindata
         self.testdata = testdata
@@ -789,6 +1699,23 @@ class ParallelTempering:
         self.num_param = (topology[0] * topology[1]) + (topology[1] * topology[2]) + topology[1] + topology[2]
         #Parallel Tempering variables
         self.swap_interval = swap_interval
+        if swap_scheme not in ("alternate", "all"):
+            raise ValueError('Unknown swap scheme {}, use "alternate" or "all".'.format(swap_scheme))
+        self.swap_scheme = swap_scheme
+        self.adapt_temperatures = adapt_temperatures
+        if replica_workers == "auto": # a process per replica while they fit on the cores, a pool of one worker per core beyond that
+            replica_workers = 0 if num_chains <= os.cpu_count() else os.cpu_count()
+        self.replica_workers = min(replica_workers, num_chains) # 0 runs one process per replica
+        self.replica_batch = replica_batch # all replicas vectorised in this process instead, true likelihood only
+        if replica_batch is True:
+            unsupported = [name for name, used in (('use_surrogate', use_surrogate is True and surrogate_prob > 0), ('delayed_acceptance', delayed_acceptance is True), ('subsample_size', subsample_size > 0), ('adapt_temperatures', adapt_temperatures is True), ('use_langevin_gradients', use_langevin_gradients is True)) if used]
+            if len(unsupported) > 0:
+                raise ValueError('replica_batch runs random walk PT on the true likelihood only, turn off {}.'.format(', '.join(unsupported)))
+        if store_thinning < 1:
+            raise ValueError('store_thinning must be at least 1, got {}.'.format(store_thinning))
+        self.store_burn_in = store_burn_in
+        self.store_thinning = store_thinning
+        self.store_skip = store_skip
         self.path = path
         self.path_db = path_db
         self.maxtemp = maxtemp
@@ -799,32 +1726,33 @@ class ParallelTempering:
         self.temperatures = []
         self.NumSamples = int(NumSample/self.num_chains)
         self.sub_sample_size = max(1, int( 0.05* self.NumSamples))
-        # create queues for transfer of parameters between process chain
-        self.parameter_queue = [multiprocessing.Queue() for i in range(num_chains)]
-        self.chain_queue = multiprocessing.JoinableQueue()
-        self.pause_chain_events = [multiprocessing.Event() for i in range (self.num_chains)]
-        self.resume_chain_events = [multiprocessing.Event() for i in range (self.num_chains)]
+        # neighbours swap directly with each other, no replica waits for anyone but its partner
+        self.swap_barriers = [multiprocessing.Barrier(2) for i in range(self.num_chains-1)]
         # create variables for surrogates
         self.surrogate_interval = surrogate_interval
         self.surrogate_prob = surrogate_prob
-        self.surrogate_resume_events = [multiprocessing.Event() for i in range(self.num_chains)]
-        self.surrogate_start_events = [multiprocessing.Event() for i in range(self.num_chains)]
-        self.surrogate_parameter_queues = [multiprocessing.Queue() for i in range(self.num_chains)]
-        self.surrchain_queue = multiprocessing.JoinableQueue()
+        self.surrogate_data_queue = multiprocessing.Queue() # row ranges of the replicas' training rings, read by the trainer
+        self.surrogate_model_queues = [multiprocessing.Queue() for i in range(self.num_chains)] # trained weights go back to the replicas here
         self.all_param = None
         self.geometric = True # True (geometric)  False (Linear)
 
         self.minlim_param = 0.0
         self.maxlim_param = 0.0
-        self.minY = np.zeros((1,1))
-        self.maxY = np.ones((1,1))
 
-        self.model_signature = 0.0
+        self.surrogate_backend = surrogate_backend
+        self.surrogate_mse_target = surrogate_mse_target
+        self.surrogate_incremental = surrogate_incremental
+        self.surrogate_archive_size = surrogate_archive_size
 
         self.use_surrogate = use_surrogate
 
         self.surrogate_topology = surrogate_topology
 
+        self.subsample_size = subsample_size
+
+        self.delayed_acceptance = delayed_acceptance
+
+        self.surrogate_audit = surrogate_audit
 
         self.save_surrogate_data =  save_surrogate_data
 
@@ -939,91 +1867,52 @@ class ParallelTempering:
 
         w = np.random.randn(self.num_param)
 
-        for i in range(0, self.num_chains):
-            self.chains.append(ptReplica(self.use_surrogate,  self.use_langevin_gradients, self.learn_rate, self.save_surrogate_data, w,  self.minlim_param, self.maxlim_param, self.NumSamples, self.traindata, self.testdata, self.topology, self.burn_in, self.temperatures[i], self.swap_interval, self.path, self.parameter_queue[i], self.pause_chain_events[i], self.resume_chain_events[i], self.surrogate_parameter_queues[i], self.surrogate_interval, self.surrogate_prob, self.surrogate_start_events[i], self.surrogate_resume_events[i], self.surrogate_topology))
-
-    def swap_procedure(self, parameter_queue_1, parameter_queue_2):
-        # if parameter_queue_2.empty() is False and parameter_queue_1.empty() is False:
-        swapped = False
-        param1 = parameter_queue_1.get()
-        param2 = parameter_queue_2.get()
-        w1 = param1[0:self.num_param]
-        eta1 = param1[self.num_param]
-        lhood1 = param1[self.num_param+1]
-        T1 = param1[self.num_param+2]
-        w2 = param2[0:self.num_param]
-        eta2 = param2[self.num_param]
-        lhood2 = param2[self.num_param+1]
-        T2 = param2[self.num_param+2]
-        #SWAPPING PROBABILITIES
-        try:
-            swap_proposal =  min(1,0.5*np.exp(min(709, lhood2 - lhood1)))
-        except OverflowError:
-            swap_proposal = 1
-        u = np.random.uniform(0,1)
-        if u < swap_proposal:
-            self.num_swap += 1
-            param_temp =  param1
-            param1 = param2
-            param2 = param_temp
-            swapped = True
-        else:
-            swapped = False
-        self.total_swap_proposals += 1
-        print("swapped: {} {}".format(param1[:2], param2[:2]))
-        return param1, param2, swapped
+        # one copy of the data for all replicas, whatever the start method
+        self.shared_traindata = SharedArray(self.traindata)
+        self.shared_testdata = SharedArray(self.testdata)
 
-    def surrogate_trainer(self,params):
-        #X = params[:,:self.num_param]
-        #Y = params[:,self.num_param].reshape(X.shape[0],1)
-        #indices = np.where(Y==np.inf)[0]
-        #X = np.delete(X, indices, axis=0)
-        #Y = np.delete(Y,indices, axis=0)
-        #surrogate_model = surrogate("nn",X,Y,self.path)
-        #surrogate_model.train()
-
-
-        X = params[:,:self.num_param]
-        Y = params[:,self.num_param].reshape(X.shape[0],1)
-
-        for i in range(Y.shape[1]):
-            min_Y = min(Y[:,i])
-            max_Y = max(Y[:,i])
-            self.minY[0,i] =   min_Y * 2
-            self.maxY[0,i] = -1#max_Y
-
-        self.model_signature += 1.0
-        if self.model_signature == 1.0:
-            np.savetxt(self.path+'/surrogate/minmax.txt',[self.minY[0, 0], self.maxY[0, 0]])
-
-        np.savetxt(self.path+'/surrogate/model_signature.txt', [self.model_signature])
-
-        Y= self.normalize_likelihood(Y)
-        indices = np.where(Y==np.inf)[0]
-        X = np.delete(X, indices, axis=0)
-        Y = np.delete(Y,indices, axis=0)
-        surrogate_model = surrogate("krnn", X , Y , self.minlim_param, self.maxlim_param, self.minY, self.maxY, self.path, self.save_surrogate_data, self.surrogate_topology )
-        surrogate_model.train(self.model_signature)
-
-
-    def normalize_likelihood(self, Y):
-        for i in range(Y.shape[1]):
-            if self.model_signature == 1.0:
-                min_Y = min(Y[:,i])
-                max_Y = max(Y[:,i])
-                # self.minY[0,i] = 1 #For Tau Squared
-                # self.maxY[0,i] = max_Y
+        self.replica_state = ReplicaState(self.num_param, self.num_chains, 2*self.surrogate_interval)
+        self.replica_state.temperature[:] = self.temperatures
 
+        if self.replica_batch is True: # the engine replaces the replica processes and has no surrogate to train
+            self.replica_engine = ReplicaBatch(w, self.temperatures, self.NumSamples, self.traindata, self.testdata, self.topology, self.swap_interval, self.swap_scheme, self.path, self.replica_state, self.burn_in, self.store_burn_in, self.store_thinning, self.store_skip)
+            return
 
-                # min -115 and max -96
-                self.maxY[0,i] = -1 #max_Y
-                self.minY[0,i] =  min_Y * 2
+        self.surrogate_trainer = SurrogateTrainer(self.num_param, self.num_chains, self.minlim_param, self.maxlim_param, self.path, self.save_surrogate_data, self.surrogate_topology, self.surrogate_backend, self.surrogate_mse_target, self.surrogate_incremental, self.surrogate_archive_size, self.surrogate_data_queue, self.surrogate_model_queues, self.replica_state)
 
-            # Y[:,i] = ([:,i] - min_Y)/(max_Y - min_Y)
+        for i in range(0, self.num_chains):
+            self.chains.append(ptReplica(self.use_surrogate,  self.use_langevin_gradients, self.learn_rate, self.save_surrogate_data, w,  self.minlim_param, self.maxlim_param, self.NumSamples, self.shared_traindata, self.shared_testdata, self.topology, self.burn_in, self.temperatures[i], self.swap_interval, self.path, self.surrogate_data_queue, self.surrogate_model_queues[i], self.surrogate_interval, self.surrogate_prob, self.surrogate_topology, self.subsample_size, self.delayed_acceptance, self.surrogate_audit, i, self.swap_barriers, self.replica_state, self.swap_scheme, self.adapt_temperatures, self.store_burn_in, self.store_thinning, self.store_skip))
 
-            Y[:,i] = (Y[:,i] - self.minY[0,0])/(self.maxY[0,0]-self.minY[0,0])
+        if self.replica_workers > 0: # replicas are spread over the workers in turn, so each worker gets a mix of cold and hot ones
+            self.block_barrier = multiprocessing.Barrier(self.replica_workers + 1)
+            self.workers = [ReplicaWorker(self.chains[k::self.replica_workers], self.block_barrier) for k in range(self.replica_workers)]
 
-        return Y
+    def swap_blocks(self):  # worker mode: between blocks every replica has published its state, the swaps are decided here
+        state = self.replica_state
+        n = self.num_param
+        for swap_round in range(1, int((self.NumSamples - 2)/self.swap_interval) + 1):
+            try:
+                self.block_barrier.wait(self.chains[0].swap_timeout) # states published
+            except threading.BrokenBarrierError:
+                print("Swapping stopped at round {}, the block barrier broke".format(swap_round))
+                return
+            temperature = state.state[state.slot, n+2].copy() # what each ladder position ran at, before any slot moves
+            for parity in ([swap_round % 2] if self.swap_scheme == "alternate" else [0, 1]):
+                for k in range(parity, self.num_chains-1, 2):
+                    lower, upper = state.slot[k], state.slot[k+1]
+                    try:
+                        swap_prob = min(1, math.exp((1.0/temperature[k] - 1.0/temperature[k+1]) * (state.state[upper, n] - state.state[lower, n])))
+                    except OverflowError as e:
+                        swap_prob = 1
+                    state.pair_attempts[k] += 1
+                    if random.uniform(0,1) < swap_prob:
+                        state.slot[k], state.slot[k+1] = upper, lower
+                        state.pair_accepts[k] += 1
+            try:
+                self.block_barrier.wait(self.chains[0].swap_timeout) # swaps decided
+            except threading.BrokenBarrierError:
+                print("Swapping stopped after round {}, the block barrier broke".format(swap_round))
+                return
 
     def plot_figure(self, lista, title,folder):
 
@@ -1125,88 +2014,48 @@ class ParallelTempering:
         filen = open(self.path + '/num_exchange.txt', 'a')
         #RUN MCMC CHAINS
 
-        for l in range(0,self.num_chains):
+        for l in range(0,len(self.chains)): # none in replica_batch mode
             self.chains[l].start_chain = start
             self.chains[l].end = end
-        for j in range(0,self.num_chains):
-            self.pause_chain_events[j].clear()
-            self.resume_chain_events[j].clear()
-            self.chains[j].start()
+            self.chains[l].launch_time = time.time()
+        if self.replica_batch is True: # no other process, the engine has no surrogate to train
+            self.replica_engine.run()
+        else:
+            self.surrogate_trainer.start() # trains whenever batches arrive, the replicas never wait for it
+            if self.replica_workers > 0:
+                for worker in self.workers:
+                    worker.start()
+                self.swap_blocks()
+            else:
+                for j in range(0,self.num_chains):
+                    self.chains[j].start()
         swaps_appected_main = 0
         total_swaps_main = 0
 
-        
- 
-
-        #SWAP PROCEDURE
-        # while True:
-        for i in range(int(self.NumSamples/self.surrogate_interval)):
-            # Check if individual processes are still alive
-            count = 0
-            for index in range(self.num_chains):
-                if not self.chains[index].is_alive():
-                    count+=1
-                    self.pause_chain_events[index].set()
-                    # print(str(self.chains[index].temperature) +" Dead")
-                # else:
-                #     print(str(self.chains[index].temperature) +" Alive")
-            if count == self.num_chains:
-                break
-            print("Waiting for swap signal.")
-
-            # Check for signal from individual chains for swap
-            signal_count = 0
-            for index in range(0,self.num_chains):
-                print("Waiting for chain: {}. Chain alive: {}".format(index+1, self.chains[index].is_alive()))
-                flag = self.pause_chain_events[index].wait()
-                if flag:
-                    print("Signal from chain: {}".format(index+1))
-                    # self.pause_chain_events[index].clear()
-                    signal_count += 1
-
-            # If signal not recieved from all chains skip the swap
-            if signal_count == self.num_chains:
-
-                all_param =   np.empty((1,self.num_param+1))
- 
-
-
-
-                for index in range(0,self.num_chains):
-                    print('starting surr')
-                    queue_surr=  self.surrogate_parameter_queues[index] 
-
-                    surr_data = queue_surr.get() 
-
-                    all_param =   np.concatenate([all_param,surr_data],axis=0) 
- 
-
-                data_train = all_param[1:,:]  
- 
-
-                self.surrogate_trainer(data_train) 
-
- 
-                for index in range(self.num_chains):
-                    self.resume_chain_events[index].set()
-                    self.pause_chain_events[index].clear() 
-
-
-            elif signal_count == 0:
-                break
-            else:
-                print("Skipping the action!")
-
-
         #JOIN THEM TO MAIN PROCESS
-        for j in range(0,self.num_chains):
-            self.chains[j].join()
-        self.chain_queue.join()
-        for i in range(0,self.num_chains):
-            #self.parameter_queue[i].close()
-            #self.parameter_queue[i].join_thread()
-            self.surrogate_parameter_queues[i].close()
-            self.surrogate_parameter_queues[i].join_thread()
+        if self.replica_batch is not True:
+            for process in (self.workers if self.replica_workers > 0 else self.chains):
+                process.join()
+            self.surrogate_trainer.join()
+        self.surrogate_data_queue.close()
+        self.surrogate_data_queue.join_thread()
+
+        ladder = self.replica_state.temperature.copy() # the adapted one if adapt_temperatures, the chains keep their initial temperature as name
+        pair_attempts = self.replica_state.pair_attempts.copy()
+        pair_accepts = self.replica_state.pair_accepts.copy()
+        self.replica_state.release()
+        self.shared_traindata.release()
+        self.shared_testdata.release()
+        self.total_swap_proposals = np.sum(pair_attempts)
+        self.num_swap = np.sum(pair_accepts)
+        RunStore(self.path).write_run(num_chains=self.num_chains, temperatures=[float(t) for t in self.temperatures], ladder=[float(t) for t in ladder], samples=self.NumSamples, burn_in=self.burn_in, num_param=self.num_param, topology=[int(n) for n in self.topology], swap_interval=self.swap_interval, swap_scheme=self.swap_scheme, swap_perc=float(self.num_swap*100.0/max(1, self.total_swap_proposals)))
+        pair_rate = 100.0*pair_accepts/np.maximum(1, pair_attempts)
+        if self.adapt_temperatures is True:
+            print("Adapted temperature ladder: {}".format(ladder))
+        for k in range(self.num_chains-1):
+            print("Swap pair {} ({} <-> {}): accepted {} of {} ({:.1f}%)".format(k, ladder[k], ladder[k+1], pair_accepts[k], pair_attempts[k], pair_rate[k]))
+        file_name = self.path + '/posterior/swap/pairs.txt' # T_low T_high attempts accepts acceptance%
+        np.savetxt(file_name, np.column_stack([ladder[:-1], ladder[1:], pair_attempts, pair_accepts, pair_rate]), fmt='%1.4f')
      
 
 
@@ -1221,7 +2070,7 @@ class ParallelTempering:
         #     self.plot_figure(pos_w[s,:], 'pos_distri_'+str(s))
         ## print("accuracies", max(acc_train), max(acc_test))
         # print("NUMBER OF SWAPS =", self.num_swap)
-        swap_perc = 0#self.num_swap*100/self.total_swap_proposals
+        swap_perc = self.num_swap*100.0/max(1, self.total_swap_proposals)
         #return (pos_w, fx_train, fx_test, x_train, x_test, rmse_train, rmse_test, accept_list)
 
         return pos_w, fx_train, fx_test,  rmse_train, rmse_test, acc_train, acc_test,  accept_list, swap_perc,  likelihood_vec, rmse_surr, surr_list, accept
@@ -1232,65 +2081,26 @@ class ParallelTempering:
 
         burnin = int(self.NumSamples*self.burn_in)
 
-        likelihood_rep = np.zeros((self.num_chains, self.NumSamples  -1, 2)) # index 1 for likelihood posterior and index 0 for Likelihood proposals. Note all likilihood proposals plotted only
-        surg_likelihood = np.zeros((self.num_chains, self.NumSamples -1 , 2)) # index 1 for likelihood proposal and for gp_prediction
-        accept_percent = np.zeros((self.num_chains, 1))
-        accept_list = np.zeros((self.num_chains, self.NumSamples ))
-
-        pos_w = np.zeros((self.num_chains,self.NumSamples - burnin, self.num_param))
-
-        fx_train_all  = np.zeros((self.num_chains,self.NumSamples - burnin, self.traindata.shape[0]))
-        rmse_train = np.zeros((self.num_chains,self.NumSamples - burnin))
-        acc_train = np.zeros((self.num_chains,self.NumSamples - burnin))
-        fx_test_all  = np.zeros((self.num_chains,self.NumSamples - burnin, self.testdata.shape[0]))
-        rmse_test = np.zeros((self.num_chains,self.NumSamples - burnin))
-        acc_test = np.zeros((self.num_chains,self.NumSamples - burnin))
-
-
-
-        for i in range(self.num_chains):
-            file_name = self.path+'/posterior/pos_w/'+'chain_'+ str(self.temperatures[i])+ '.txt'
-            dat = np.loadtxt(file_name)
-            pos_w[i,:,:] = dat[burnin:,:]
-
-            file_name = self.path + '/posterior/pos_likelihood/'+'chain_' + str(self.temperatures[i]) + '.txt'
-            dat = np.loadtxt(file_name)
-            likelihood_rep[i, :] = dat[1:,:]
-
-            file_name = self.path + '/posterior/surg_likelihood/'+'chain_' + str(self.temperatures[i]) + '.txt'
-            dat = np.loadtxt(file_name)
-            surg_likelihood[i, :] = dat[1:,0:2]
-
-            file_name = self.path + '/posterior/accept_list/' + 'chain_'  + str(self.temperatures[i]) + '.txt'
-            dat = np.loadtxt(file_name)
-            accept_list[i, :] = dat
-
-            file_name = self.path + '/posterior/accept_list/' + 'chain_' + str(self.temperatures[i]) + '_accept.txt'
-            dat = np.loadtxt(file_name)
-            accept_percent[i, :] = dat
+        store = RunStore(self.path)
 
-            '''file_name = self.path+'/predictions/fxtrain_samples_chain_'+ str(self.temperatures[i])+ '.txt'
-            dat = np.loadtxt(file_name)
-            fx_train_all[i,:,:] = dat[burnin:,:]
-            file_name = self.path+'/predictions/fxtest_samples_chain_'+ str(self.temperatures[i])+ '.txt'
-            dat = np.loadtxt(file_name)
-            fx_test_all[i,:,:] = dat[burnin:,:]'''
+        def chains(name, sample, row_shape=()):  # (num_chains, rows, ...) from sample on as the chains stored it, NaN for a list in store_skip
+            if name in self.store_skip:
+                return np.full((self.num_chains, self.NumSamples - sample) + row_shape, np.nan)
+            return np.stack([store.read_after(temperature, name, sample, row_shape) for temperature in self.temperatures])
 
-            file_name = self.path+'/predictions/rmse_test_chain_'+ str(self.temperatures[i])+ '.txt'
-            dat = np.loadtxt(file_name)
-            rmse_test[i,:] = dat[burnin:]
+        likelihood_rep = chains('pos_likelihood', 1, (2,)) # index 1 for likelihood posterior and index 0 for Likelihood proposals. Note all likilihood proposals plotted only
+        surg_likelihood = chains('surg_likelihood', 1, (3,))[:, :, 0:2] # index 1 for likelihood proposal and for gp_prediction
+        accept_percent = np.array([[store.metadata(temperature)['accept_ratio']] for temperature in self.temperatures])
+        accept_list = chains('accept_list', 0)
 
-            file_name = self.path+'/predictions/rmse_train_chain_'+ str(self.temperatures[i])+ '.txt'
-            dat = np.loadtxt(file_name)
-            rmse_train[i,:] = dat[burnin:]
+        pos_w = chains('pos_w', burnin, (self.num_param,)) # burn-in and thinning as stored, see store_burn_in and store_thinning
 
-            file_name = self.path+'/predictions/acc_test_chain_'+ str(self.temperatures[i])+ '.txt'
-            dat = np.loadtxt(file_name)
-            acc_test[i,:] = dat[burnin:]
-
-            file_name = self.path+'/predictions/acc_train_chain_'+ str(self.temperatures[i])+ '.txt'
-            dat = np.loadtxt(file_name)
-            acc_train[i,:] = dat[burnin:]
+        fx_train_all  = np.zeros((self.num_chains, pos_w.shape[1], self.traindata.shape[0]))
+        rmse_train = chains('rmse_train', burnin)
+        acc_train = chains('acc_train', burnin)
+        fx_test_all  = np.zeros((self.num_chains, pos_w.shape[1], self.testdata.shape[0]))
+        rmse_test = chains('rmse_test', burnin)
+        acc_test = chains('acc_test', burnin)
 
         #print(surg_likelihood)
         print(surg_likelihood.shape, ' surg_likelihood.shape')
@@ -1307,10 +2117,10 @@ class ParallelTempering:
         likelihood_vec = likelihood_rep.transpose(2,0,1).reshape(2,-1)
         surg_likelihood_vec = surg_likelihood.transpose(2,0,1).reshape(2,-1)
 
-        rmse_train = rmse_train.reshape(self.num_chains*(self.NumSamples - burnin), 1)
-        acc_train = acc_train.reshape(self.num_chains*(self.NumSamples - burnin), 1)
-        rmse_test = rmse_test.reshape(self.num_chains*(self.NumSamples - burnin), 1)
-        acc_test = acc_test.reshape(self.num_chains*(self.NumSamples - burnin), 1)
+        rmse_train = rmse_train.reshape(-1, 1)
+        acc_train = acc_train.reshape(-1, 1)
+        rmse_test = rmse_test.reshape(-1, 1)
+        acc_test = acc_test.reshape(-1, 1)
 
         rmse_surr =0
 
@@ -1319,14 +2129,16 @@ class ParallelTempering:
 
 
         if self.use_surrogate is True:
-
             surr_list = surg_likelihood_vec.T
-
             surrogate_likl = surg_likelihood_vec.T
             surrogate_likl = surrogate_likl[~np.isnan(surrogate_likl).any(axis=1)]
+            if surrogate_likl.shape[0] == 0:
+                print('no audited surrogate steps, rmse_surr not computed')
 
+        if self.use_surrogate is True and surrogate_likl.shape[0] > 0:
 
             rmse_surr =  np.sqrt(((surrogate_likl[:,1]-surrogate_likl[:,0])**2).mean())
+            print(surrogate_likl.shape[0], ' audited surrogate steps in rmse_surr')
 
 
             #print(rmse_surr, ' rmse_surr')
@@ -1554,7 +2366,14 @@ def main():
 
     maxtemp = 2
     swap_interval = 5  #  #how ofen you swap neighbours
+    swap_scheme = "alternate" # "alternate": even and odd adjacent pairs take turns each swap round, "all": every adjacent pair each round (even pairs, then odd)
+    replica_batch = False # advance all replicas together in this process with one batched likelihood pass per step, random walk on the true likelihood, fastest on small data such as Iris and Cancer. needs surrogate_prob 0 (or use_surrogate False), no delayed_acceptance, subsample_size, adapt_temperatures or Langevin gradients
+    replica_workers = "auto" # processes advancing the replicas in blocks of swap_interval samples, 0 runs one process per replica, "auto" switches to os.cpu_count() workers once there are more replicas than cores
+    adapt_temperatures = False # Vousden et al. (2016): during burn-in the rungs between the coldest and hottest move until adjacent pairs swap equally often
     burn_in = 0.6
+    store_burn_in = True # the run store keeps pos_w, rmse and accuracy from the end of burn-in on, they are only read from there. False keeps the whole chain
+    store_thinning = 1 # and every so many samples of them
+    store_skip = [] # saved lists not written at all, e.g. ['surg_likelihood', 'accept_list'], show_results reads them as NaN
 
     #surrogate_prob = 0.5
     use_surrogate = True # if you set this to false, you get canonical PT - also make surrogate prob 0
@@ -1607,6 +2426,20 @@ def main():
 
     learn_rate = 0.01
 
+    subsample_size = 0 # opt-in minibatch likelihood: rows per estimate (or fraction of the training set if < 1), 0 use the full training set. try 0.05 for bank-additional and PenDigit
+
+    delayed_acceptance = False # once the surrogate is trained it screens every proposal, the true likelihood is only paid for proposals it lets through. surrogate_prob is ignored
+
+    surrogate_audit = 0.1 # fraction of surrogate steps checked against the true likelihood in the background for rmse_surr, 1 audits every step
+
+    surrogate_backend = "krnn" # keras nn, or the lightweight "gp" (sparse GP), "rff" (random Fourier features + ridge), "knn", or "auto" to pick the fastest one meeting surrogate_mse_target
+
+    surrogate_mse_target = 1e-5 # on the normalised likelihood (about 2-3 log-likelihood units on Cancer), only used by "auto"
+
+    surrogate_incremental = False # update the surrogate with each new batch (partial_fit) instead of refitting, keeps retraining cost flat per interval
+
+    surrogate_archive_size = 20000 # rows of (w, likelihood) the trainer keeps over the whole run (float32), split evenly over the temperatures
+
     pt_samples = int(0.6 * NumSample/num_chains)   # this is for PT first stage. then sampling becomes MCMC canonical later
 
     timer = time.time()
@@ -1617,9 +2450,9 @@ def main():
 #Statements
 
 
-    pt = ParallelTempering(use_surrogate,  use_langevin_gradients, learn_rate,  save_surrogate_data, traindata, testdata, topology, num_chains, maxtemp, NumSample, swap_interval, surrogate_interval, surrogate_prob, path, path_db, surrogate_topology)
+    pt = ParallelTempering(use_surrogate,  use_langevin_gradients, learn_rate,  save_surrogate_data, traindata, testdata, topology, num_chains, maxtemp, NumSample, swap_interval, surrogate_interval, surrogate_prob, path, path_db, surrogate_topology, subsample_size, delayed_acceptance, surrogate_audit, surrogate_backend, surrogate_mse_target, surrogate_incremental, surrogate_archive_size, swap_scheme, adapt_temperatures, replica_workers, replica_batch, store_burn_in, store_thinning, store_skip)
 
-    directories = [  path+'/predictions/', path+'/posterior', path+'/results', path+'/surrogate', path+'/surrogate/learnsurrogate_data', path+'/posterior/pos_w',  path+'/posterior/pos_likelihood',path+'/posterior/surg_likelihood',path+'/posterior/accept_list'  ]
+    directories = [  path+'/posterior', path+'/results', path+'/surrogate', path+'/surrogate/learnsurrogate_data', path+'/posterior/surg_likelihood', path+'/posterior/swap', path+'/posterior/resources'  ]
 
     for d in directories:
         pt.make_directory((filename)+ d)
@@ -1671,25 +2504,27 @@ def main():
     rmsetes_max = np.amax(acc_train[:])
 
 
-    surrgate_intervalres = np.loadtxt(path+'/surrogate/train_metrics.txt')
-    # print(surrgate_intervalres, ' surrgate_intervalres')
+    surr_meantrain = surr_stdtrain = np.nan # no surrogate is trained in replica_batch mode, so there are no interval metrics
+    if replica_batch is not True:
+        surrgate_intervalres = np.loadtxt(path+'/surrogate/train_metrics.txt')
+        # print(surrgate_intervalres, ' surrgate_intervalres')
 
-    fig = plt.figure()
-    #ax = fig.add_subplot(111)
+        fig = plt.figure()
+        #ax = fig.add_subplot(111)
 
-    x = np.arange(0, surrgate_intervalres.shape[0], 1) 
+        x = np.arange(0, surrgate_intervalres.shape[0], 1) 
 
-    plt.bar(x,surrgate_intervalres  )
-    plt.xlabel('Surrogate Interval ', fontsize=14)
-    plt.ylabel(' RMSE', fontsize=14)
-    plt.legend(loc='upper right')
-    plt.savefig(path_db+'/surrogate_intervalerror.png' )
+        plt.bar(x,surrgate_intervalres  )
+        plt.xlabel('Surrogate Interval ', fontsize=14)
+        plt.ylabel(' RMSE', fontsize=14)
+        plt.legend(loc='upper right')
+        plt.savefig(path_db+'/surrogate_intervalerror.png' )
 
-    plt.clf()
+        plt.clf()
 
 
-    surr_meantrain = np.mean(surrgate_intervalres)
-    surr_stdtrain = np.std(surrgate_intervalres)
+        surr_meantrain = np.mean(surrgate_intervalres)
+        surr_stdtrain = np.std(surrgate_intervalres)
 
 
 
@@ -61,10 +61,17 @@ class Network:
 		self.TrainData = Train
 		self.TestData = Test
 		self.lrate = learn_rate
-		self.W1 = np.random.randn(self.Top[0], self.Top[1]) / np.sqrt(self.Top[0])
-		self.B1 = np.random.randn(1, self.Top[1]) / np.sqrt(self.Top[1])  # bias first layer
-		self.W2 = np.random.randn(self.Top[1], self.Top[2]) / np.sqrt(self.Top[1])
-		self.B2 = np.random.randn(1, self.Top[2]) / np.sqrt(self.Top[1])  # bias second layer
+		w_layer1size = self.Top[0] * self.Top[1]
+		w_layer2size = self.Top[1] * self.Top[2]
+		self.w_flat = np.zeros(w_layer1size + w_layer2size + self.Top[1] + self.Top[2])  # single contiguous buffer, W1 W2 B1 B2 are persistent views into it
+		self.W1 = self.w_flat[0:w_layer1size].reshape(self.Top[0], self.Top[1])
+		self.W2 = self.w_flat[w_layer1size:w_layer1size + w_layer2size].reshape(self.Top[1], self.Top[2])
+		self.B1 = self.w_flat[w_layer1size + w_layer2size:w_layer1size + w_layer2size + self.Top[1]].reshape(1, self.Top[1])
+		self.B2 = self.w_flat[w_layer1size + w_layer2size + self.Top[1]:].reshape(1, self.Top[2])
+		self.W1[:] = np.random.randn(self.Top[0], self.Top[1]) / np.sqrt(self.Top[0])
+		self.B1[:] = np.random.randn(1, self.Top[1]) / np.sqrt(self.Top[1])  # bias first layer
+		self.W2[:] = np.random.randn(self.Top[1], self.Top[2]) / np.sqrt(self.Top[1])
+		self.B2[:] = np.random.randn(1, self.Top[2]) / np.sqrt(self.Top[1])  # bias second layer
 		self.hidout = np.zeros((1, self.Top[1]))  # output of first hidden layer
 		self.out = np.zeros((1, self.Top[2]))  # output last layer
 		self.pred_class = 0
@@ -101,27 +108,11 @@ class Network:
 
 
 	def decode(self, w):
-		w_layer1size = self.Top[0] * self.Top[1]
-		w_layer2size = self.Top[1] * self.Top[2]
-
-		w_layer1 = w[0:w_layer1size]
-		self.W1 = np.reshape(w_layer1, (self.Top[0], self.Top[1]))
-
-		w_layer2 = w[w_layer1size:w_layer1size + w_layer2size]
-		self.W2 = np.reshape(w_layer2, (self.Top[1], self.Top[2]))
-		self.B1 = w[w_layer1size + w_layer2size:w_layer1size + w_layer2size + self.Top[1]].reshape(1,self.Top[1])
-		self.B2 = w[w_layer1size + w_layer2size + self.Top[1]:w_layer1size + w_layer2size + self.Top[1] + self.Top[2]].reshape(1,self.Top[2])
-
+		np.copyto(self.w_flat, w)  # loading a proposal is one copy, the layer views see it directly
 
 
 	def encode(self):
-		w1 = self.W1.ravel()
-		w1 = w1.reshape(1,w1.shape[0])
-		w2 = self.W2.ravel()
-		w2 = w2.reshape(1,w2.shape[0])
-		w = np.concatenate([w1.T, w2.T, self.B1.T, self.B2.T])
-		w = w.reshape(-1)
-		return w
+		return self.w_flat  # no copy, callers that keep the result past the next decode must copy it
 
 	def softmax(self):
 		prob = np.exp(self.out)/np.sum(np.exp(self.out))
@@ -145,7 +136,7 @@ class Network:
 				Desired = data[pat, self.Top[0]:]
 				self.ForwardPass(Input)
 				self.BackwardPass(Input, Desired)
-		w_updated = self.encode()
+		w_updated = self.encode().copy()
 
 		return  w_updated
 
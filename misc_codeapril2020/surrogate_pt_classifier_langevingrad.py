@@ -54,10 +54,17 @@ class Network:
 		self.TrainData = Train
 		self.TestData = Test
 		self.lrate = learn_rate
-		self.W1 = np.random.randn(self.Top[0], self.Top[1]) / np.sqrt(self.Top[0])
-		self.B1 = np.random.randn(1, self.Top[1]) / np.sqrt(self.Top[1])  # bias first layer
-		self.W2 = np.random.randn(self.Top[1], self.Top[2]) / np.sqrt(self.Top[1])
-		self.B2 = np.random.randn(1, self.Top[2]) / np.sqrt(self.Top[1])  # bias second layer
+		w_layer1size = self.Top[0] * self.Top[1]
+		w_layer2size = self.Top[1] * self.Top[2]
+		self.w_flat = np.zeros(w_layer1size + w_layer2size + self.Top[1] + self.Top[2])  # single contiguous buffer, W1 W2 B1 B2 are persistent views into it
+		self.W1 = self.w_flat[0:w_layer1size].reshape(self.Top[0], self.Top[1])
+		self.W2 = self.w_flat[w_layer1size:w_layer1size + w_layer2size].reshape(self.Top[1], self.Top[2])
+		self.B1 = self.w_flat[w_layer1size + w_layer2size:w_layer1size + w_layer2size + self.Top[1]].reshape(1, self.Top[1])
+		self.B2 = self.w_flat[w_layer1size + w_layer2size + self.Top[1]:].reshape(1, self.Top[2])
+		self.W1[:] = np.random.randn(self.Top[0], self.Top[1]) / np.sqrt(self.Top[0])
+		self.B1[:] = np.random.randn(1, self.Top[1]) / np.sqrt(self.Top[1])  # bias first layer
+		self.W2[:] = np.random.randn(self.Top[1], self.Top[2]) / np.sqrt(self.Top[1])
+		self.B2[:] = np.random.randn(1, self.Top[2]) / np.sqrt(self.Top[1])  # bias second layer
 		self.hidout = np.zeros((1, self.Top[1]))  # output of first hidden layer
 		self.out = np.zeros((1, self.Top[2]))  # output last layer
 		self.pred_class = 0
@@ -81,6 +88,16 @@ class Network:
 
 		#print(self.pred_class, self.out, '  ---------------- out ')
 
+	def BatchForwardPass(self, X): # whole data matrix at once, hidout and out are kept for langevin_gradient
+		# stacked (N,1,in) products keep the per-row accumulation order so results match ForwardPass bit for bit
+		z1 = np.matmul(X[:, np.newaxis, :], self.W1) - self.B1
+		hidout = self.sigmoid(z1)
+		z2 = np.matmul(hidout, self.W2) - self.B2
+		self.hidout = hidout[:, 0, :]
+		self.out = self.sigmoid(z2)[:, 0, :]
+
+		self.pred_class = np.argmax(self.out, axis=1)
+
 	'''def BackwardPass(self, Input, desired):
 		out_delta = (desired - self.out).dot(self.out.dot(1 - self.out))
 		hid_delta = out_delta.dot(self.W2.T) * (self.hidout * (1 - self.hidout))
@@ -107,39 +124,50 @@ class Network:
 
 
 	def decode(self, w):
-		w_layer1size = self.Top[0] * self.Top[1]
-		w_layer2size = self.Top[1] * self.Top[2]
+		np.copyto(self.w_flat, w)  # loading a proposal is one copy, the layer views see it directly
 
-		w_layer1 = w[0:w_layer1size]
-		self.W1 = np.reshape(w_layer1, (self.Top[0], self.Top[1]))
-
-		w_layer2 = w[w_layer1size:w_layer1size + w_layer2size]
-		self.W2 = np.reshape(w_layer2, (self.Top[1], self.Top[2]))
-		self.B1 = w[w_layer1size + w_layer2size:w_layer1size + w_layer2size + self.Top[1]].reshape(1,self.Top[1])
-		self.B2 = w[w_layer1size + w_layer2size + self.Top[1]:w_layer1size + w_layer2size + self.Top[1] + self.Top[2]].reshape(1,self.Top[2])
-
- 
 
 	def encode(self):
-		w1 = self.W1.ravel()
-		w1 = w1.reshape(1,w1.shape[0])
-		w2 = self.W2.ravel()
-		w2 = w2.reshape(1,w2.shape[0])
-		w = np.concatenate([w1.T, w2.T, self.B1.T, self.B2.T])
-		w = w.reshape(-1)
-		return w
+		return self.w_flat  # no copy, callers that keep the result past the next decode must copy it
 
 	def softmax(self):
-		prob = np.exp(self.out)/np.sum(np.exp(self.out))
+		prob = np.exp(self.out)/np.sum(np.exp(self.out), axis=-1, keepdims=True)
 		return prob
  
 
 
-	def langevin_gradient(self, data, w, depth):  # BP with SGD (Stocastic BP)
+	def langevin_gradient(self, data, w, depth, temperature=1.0, sigma_squared=25.0, reuse_forward=False, batch_size=None, batch=True):  # batch=False keeps per pattern SGD
 
 		self.decode(w)  # method to decode w into W1, W2, B1, B2.
 		size = data.shape[0]
 
+		if batch is True:
+			# gradient ascent on the tempered log-posterior: softmax categorical likelihood / temperature + gaussian prior
+			# reuse_forward=True takes hidout and out left by the last evaluate_proposal(data, w), so the step only costs the backward pass
+			for i in range(0, depth):
+				if batch_size is None:
+					rows = data
+				else:
+					rows = data[np.random.choice(size, batch_size, replace=False)]
+				Input = rows[:, 0:self.Top[0]]
+				if reuse_forward is False or i > 0 or batch_size is not None:
+					self.BatchForwardPass(Input)
+				onehot = np.zeros((rows.shape[0], self.Top[2]))
+				onehot[np.arange(rows.shape[0]), rows[:, self.Top[0]].astype(int)] = 1
+				out_delta = (onehot - self.softmax()) * (self.out * (1 - self.out)) / temperature
+				hid_delta = np.dot(out_delta, self.W2.T) * (self.hidout * (1 - self.hidout))
+				scale = size / rows.shape[0]  # mini-batch sums are scaled up to the full data
+				grad_W2 = scale * np.dot(self.hidout.T, out_delta) - self.W2 / sigma_squared
+				grad_B2 = -scale * np.sum(out_delta, axis=0, keepdims=True) - self.B2 / sigma_squared
+				grad_W1 = scale * np.dot(Input.T, hid_delta) - self.W1 / sigma_squared
+				grad_B1 = -scale * np.sum(hid_delta, axis=0, keepdims=True) - self.B1 / sigma_squared
+				step = self.lrate  # on the summed gradient, i.e. the drift of one per pattern SGD epoch at learn_rate
+				self.W2 += step * grad_W2
+				self.B2 += step * grad_B2
+				self.W1 += step * grad_W1
+				self.B1 += step * grad_B1
+			return self.encode().copy()
+
 		Input = np.zeros((1, self.Top[0]))  # temp hold input
 		Desired = np.zeros((1, self.Top[2]))
 		fx = np.zeros(size)
@@ -151,15 +179,21 @@ class Network:
 				Desired = data[pat, self.Top[0]:]
 				self.ForwardPass(Input)
 				self.BackwardPass(Input, Desired)
-		w_updated = self.encode()
+		w_updated = self.encode().copy()
 
 		return  w_updated
 
-	def evaluate_proposal(self, data, w ):  # BP with SGD (Stocastic BP)
+	def evaluate_proposal(self, data, w, batch=True):  # batch=False keeps the original row by row loop
 
 		self.decode(w)  # method to decode w into W1, W2, B1, B2.
 		size = data.shape[0]
 
+		if batch is True:
+			self.BatchForwardPass(data[:, 0:self.Top[0]])
+			fx = self.pred_class.astype(float)
+			prob = self.softmax()
+			return fx, prob
+
 		Input = np.zeros((1, self.Top[0]))  # temp hold input
 		Desired = np.zeros((1, self.Top[2]))
 		fx = np.zeros(size)
@@ -504,6 +538,8 @@ class ptReplica(multiprocessing.Process):
 		reject_counter_inf = 0
 
 		langevin_count = 0
+		w_gd = None
+		w_gd_source = None # weights w_gd was computed at
 
 
 
@@ -549,6 +585,7 @@ class ptReplica(multiprocessing.Process):
 
   
 			w_proposal = np.random.normal(w, step_w, w_size) 
+			w_prop_gd = None
  
 			ku = random.uniform(0,1)   
  
@@ -612,44 +649,24 @@ class ptReplica(multiprocessing.Process):
 				diff_prop = 0 
 				prior_prop = self.prior_likelihood(sigma_squared, nu_1, nu_2, w_proposal)  # takes care of the gradients '''
 
-				is_true_lhood = True 
+				is_true_lhood = True
 				trainset_empty = False
 
 				surg_likeh_list[i+1,1] =  np.nan
 
+				lx = np.random.uniform(0,1,1)
+				use_gradient = (self.use_langevin_gradients is True) and (lx< self.l_prob)
 
+				if use_gradient is True:
+					if w_gd_source is None or not np.array_equal(w_gd_source, w): # gradient at w is not left over from the accepted proposal (first step, surrogate or random-walk move)
+						w_gd = fnn.langevin_gradient(self.traindata, w, self.sgd_depth, self.adapttemp, sigma_squared) # Eq 8
+						w_gd_source = w.copy()
+					w_proposal = np.random.normal(w_gd, step_w, w_size) # Eq 7
 
 				[likelihood_proposal, pred_train, rmsetrain, likl_without_temp] = self.likelihood_func(fnn, self.traindata, w_proposal)
-				[_, pred_test, rmsetest, likl_without_temp_] = self.likelihood_func(fnn, self.testdata, w_proposal)
-
-				likl_wo_temp = np.array([likl_without_temp]) 
-				X, Y = w_proposal,likl_wo_temp
-				X = X.reshape(1, X.shape[0])
-				Y = Y.reshape(1, Y.shape[0])
-				param_train = np.concatenate([X, Y],axis=1)
-				surr_train_set = np.vstack((surr_train_set, param_train))
-				
-
-
-				surg_likeh_list[i+1,0] = likelihood_proposal 
-				surg_likeh_list[i+1,2] = likelihood_proposal
- 
-
 
-
-
-
-
-
-
-
-
-				lx = np.random.uniform(0,1,1)
-
-				if (self.use_langevin_gradients is True) and (lx< self.l_prob):  
-					w_gd = fnn.langevin_gradient(self.traindata, w.copy(), self.sgd_depth) # Eq 8
-					w_proposal = np.random.normal(w_gd, step_w, w_size) # Eq 7
-					w_prop_gd = fnn.langevin_gradient(self.traindata, w_proposal.copy(), self.sgd_depth) 
+				if use_gradient is True:
+					w_prop_gd = fnn.langevin_gradient(self.traindata, w_proposal, self.sgd_depth, self.adapttemp, sigma_squared, reuse_forward=True) # backward pass only, the forward pass is the likelihood just above
 					#first = np.log(multivariate_normal.pdf(w , w_prop_gd , sigma_diagmat)) 
 					#second = np.log(multivariate_normal.pdf(w_proposal , w_gd , sigma_diagmat)) # this gives numerical instability - hence we give a simple implementation next that takes out log 
 
@@ -661,22 +678,22 @@ class ptReplica(multiprocessing.Process):
 					first = -0.5 * np.sum(wc_delta  *  wc_delta  ) / sigma_sq  # this is wc_delta.T  *  wc_delta /sigma_sq
 					second = -0.5 * np.sum(wp_delta * wp_delta ) / sigma_sq
 
-				
 					diff_prop =  first - second  
-
-
 					diff_prop =  diff_prop/self.adapttemp
 
-
 					langevin_count = langevin_count + 1
 
-					#print(langevin_count, diff_prop, first, second)  
-					
+				[_, pred_test, rmsetest, likl_without_temp_] = self.likelihood_func(fnn, self.testdata, w_proposal)
 
-				[likelihood_proposal, pred_train, rmsetrain, likl_without_temp] = self.likelihood_func(fnn, self.traindata, w_proposal)
-				[_, pred_test, rmsetest, likl_without_temp_] = self.likelihood_func(fnn, self.testdata, w_proposal) 
-				surg_likeh_list[i+1,1] =  np.nan
-				surg_likeh_list[i+1,0] = likelihood_proposal  
+				likl_wo_temp = np.array([likl_without_temp]) 
+				X, Y = w_proposal,likl_wo_temp
+				X = X.reshape(1, X.shape[0])
+				Y = Y.reshape(1, Y.shape[0])
+				param_train = np.concatenate([X, Y],axis=1)
+				surr_train_set = np.vstack((surr_train_set, param_train))
+
+				surg_likeh_list[i+1,0] = likelihood_proposal 
+				surg_likeh_list[i+1,2] = likelihood_proposal
 
 
 
@@ -713,6 +730,9 @@ class ptReplica(multiprocessing.Process):
 				likelihood_copy = likelihood_proposal
 				prior_current = prior_prop
 				w = w_proposal
+				if w_prop_gd is not None: # keep the gradient of the new state for the next Langevin step
+					w_gd = w_prop_gd
+					w_gd_source = w_proposal.copy()
 					 
 
 				pos_w[i + 1,] = w_proposal 